@@ -19,6 +19,8 @@ import gettext
 import os
 import time
 
+import gtk
+
 from flumotion.common.mimetypes import launchApplicationByUrl
 from flumotion.component.base.admin_gtk import BaseAdminGtk
 from flumotion.component.base.baseadminnode import BaseAdminGtkNode
@@ -38,6 +40,8 @@ class StatisticsAdminGtkNode(BaseAdminGtkNode):
         self._stats = None
         self._link = None
         self._labels = {}
+        self._timings = None
+        self._latency = None
 
     # BaseAdminGtkNode
 
@@ -53,6 +57,10 @@ class StatisticsAdminGtkNode(BaseAdminGtkNode):
             self._registerLabel('clients-' + name)
         for name in ['bitrate', 'bitrate-current', 'totalbytes']:
             self._registerLabel('consumption-' + name)
+        self._latency = self._createStatsView(_('Availability latency'),
+                                              [_('Quality')])
+        self._timings = self._createStatsView(_('Ingest timings'),
+                                              [_('Quality'), _('Stage')])
 
         if self._stats:
             self._shown = True
@@ -106,6 +114,12 @@ class StatisticsAdminGtkNode(BaseAdminGtkNode):
 
             self._labels[name].set_text(text)
 
+        if self._timings is not None:
+            self._updateStatsView(self._latency,
+                                  state.get('ingest-latency') or {})
+            self._updateStatsView(self._timings,
+                                  state.get('ingest-timings') or {})
+
         uri = state.get('stream-url', '')
         if not self._link and uri:
             self._link = self._createLinkWidget(uri)
@@ -118,6 +132,34 @@ class StatisticsAdminGtkNode(BaseAdminGtkNode):
             self._link.set_tooltip_text((disable and tooltip) or '')
             self._link.set_uri(uri)
 
+    def _createStatsView(self, title, keys):
+        # a row per key, with the median, 95th percentile and maximum
+        titles = keys + [_('Median (ms)'), _('95th percentile (ms)'),
+                         _('Maximum (ms)')]
+        model = gtk.ListStore(*[str] * len(titles))
+        view = gtk.TreeView(model)
+        for i, title in enumerate(titles):
+            column = gtk.TreeViewColumn(title, gtk.CellRendererText(),
+                                        text=i)
+            view.append_column(column)
+        expander = gtk.Expander(title)
+        expander.add(view)
+        self._statistics.pack_start(expander, False, False)
+        return model
+
+    def _updateStatsView(self, model, stats):
+        # the keys are the row keys and the statistic, separated by /
+        rows = {}
+        for key, value in stats.items():
+            parts = key.split('/')
+            row = rows.setdefault(tuple(parts[:-1]), {})
+            row[parts[-1]] = '%.2f' % value
+        model.clear()
+        for key in sorted(rows):
+            row = rows[key]
+            model.append(list(key) + [row.get('p50', ''), row.get('p95', ''),
+                                      row.get('max', '')])
+
     def _createLinkWidget(self, uri):
         holder = self.wtree.get_widget('link-holder')
         if holder is None:
@@ -15,20 +15,28 @@
 #
 # Headers in this file shall remain intact.
 
+import threading
+from collections import deque
+
 import gst
 
 from cStringIO import StringIO as cStringIO
 from StringIO import StringIO
 from mp4seek import iso, atoms
+from twisted.internet import task
 
 from flumotion.common import messages
 from flumotion.common.i18n import N_, gettexter
 from flumotion.component import feedcomponent
+from flumotion.component.consumers.smoothstreamer import boxes
 
 __all__ = ['FMP4Aggregator']
 __version__ = "$Rev$"
 T_ = gettexter()
 
+DEFAULT_MAX_QUEUE_DURATION = 4.0 # in seconds
+STATS_INTERVAL = 5.0
+
 
 class FMP4Aggregator(feedcomponent.ParseLaunchComponent):
     '''
@@ -43,6 +51,15 @@ class FMP4Aggregator(feedcomponent.ParseLaunchComponent):
     prelloled, every sink is given a track id and a new moov is build with
     the n tracks. For new incomming fragment, the moof is rewritten changing
     the track id, which would be 1 for all them otherwise.
+
+    An input can be restarted alone: its new moov replaces the track it had
+    in the combined one, keeping its track id, and a new moov is only pushed
+    downstream when the codec configuration of the track changed.
+
+    Fragments wait in a queue per sink and are pushed ordered by timestamp.
+    An input that is late or dead for longer than the max queue duration
+    is skipped instead of blocking the others, and the fragments it sends
+    afterwards, older than the ones already pushed, are dropped.
     '''
     logCategory = 'fmp4-aggregator'
     dropStreamHeaders = False
@@ -50,7 +67,18 @@ class FMP4Aggregator(feedcomponent.ParseLaunchComponent):
     _moov = None
     _streamheaders = None
     _outputcaps = None
-    _sinks = {} # sink -> {got_headers: bool , queue: [], id: int}
+
+    def init(self):
+        self._sinks = {} # sink -> {got_headers: bool, queue: deque, id: int,
+                         #          stsd: str, preroll: buffer, ...}
+        self._lock = threading.Lock() # the queues, taken by the sinks
+        self._pushLock = threading.Lock() # taken while pushing downstream
+        self._outgoing = deque() # buffers to push downstream, in order
+        self._lastPushed = None # timestamp of the last fragment pushed
+        self._maxQueueDuration = 0
+        self._statsPoller = None
+        for k in ('queue-depth', 'queue-drops', 'queue-late'):
+            self.uiState.addDictKey(k, {})
 
     def get_pipeline_string(self, properties):
         # Similar to the MultiInputParseLaunch component but whithout the need
@@ -72,21 +100,43 @@ class FMP4Aggregator(feedcomponent.ParseLaunchComponent):
                 pipeline += ' @ eater:%s @ !  appsink '\
                             'name=sink_%s emit-signals=true sync=false '\
                             % (alias, alias)
-        pipeline += ' appsrc is-live=true name=output '
+        # block the sinks while downstream does not take the fragments
+        pipeline += ' appsrc is-live=true block=true name=output '
         return pipeline
 
     def configure_pipeline(self, pipeline, properties):
+        self._maxQueueDuration = int(properties.get('max-queue-duration',
+            DEFAULT_MAX_QUEUE_DURATION) * gst.SECOND)
         eaters = self.config.get('eater', {})
         self.n_preroll_eaters = len(eaters)
         for e in eaters:
             for feed, alias in eaters[e]:
-                sink = self.pipeline.get_by_name('sink_%s' % alias)
-                sink.connect("new-buffer", self._new_buffer)
-                sink.connect("new-preroll", self._new_preroll)
-                tid = len(self._sinks) + 1
-                self._sinks[sink] = {'got_headers': False, 'queue': [],
-                                     'id': tid}
+                self._addSink(self.pipeline.get_by_name('sink_%s' % alias),
+                              alias)
         self._appsrc = pipeline.get_by_name('output')
+        self._statsPoller = task.LoopingCall(self._updateStats)
+        self._statsPoller.start(STATS_INTERVAL)
+
+    def _addSink(self, sink, alias):
+        sink.connect("new-buffer", self._new_buffer)
+        sink.connect("new-preroll", self._new_preroll)
+        tid = len(self._sinks) + 1
+        self._sinks[sink] = {'got_headers': False, 'queue': deque(),
+                             'id': tid, 'name': alias, 'dropped': 0,
+                             'late': 0, 'stsd': None, 'preroll': None}
+
+    def do_stop(self):
+        if self._statsPoller and self._statsPoller.running:
+            self._statsPoller.stop()
+        return feedcomponent.ParseLaunchComponent.do_stop(self)
+
+    def _updateStats(self):
+        # read without the lock, the reactor must never wait for the
+        # streaming threads and the counters are only informative
+        for d in self._sinks.values():
+            self.uiState.setitem('queue-depth', d['name'], len(d['queue']))
+            self.uiState.setitem('queue-drops', d['name'], d['dropped'])
+            self.uiState.setitem('queue-late', d['name'], d['late'])
 
     def _all_sinks_prerolled(self):
         return False not in map(lambda s: s['got_headers'],
@@ -124,11 +174,30 @@ class FMP4Aggregator(feedcomponent.ParseLaunchComponent):
         if self._moov is None:
             self._moov = moov
         else:
-            self._moov.trak.append(trak)
+            # a restarted input replaces its previous track
+            for i, t in enumerate(self._moov.trak):
+                if t.tkhd.id == tid:
+                    self._moov.trak[i] = trak
+                    break
+            else:
+                self._moov.trak.append(trak)
         self._update_caps(buf.caps)
         return True
 
     def _update_trak_id(self, buf, tid):
+        # gst buffers expose their memory through the buffer interface, so
+        # only the box headers are read to reach the tfhd, and its track id
+        # is patched in place unless the buffer is shared, in which case
+        # make_writable copies it, keeping the timestamps and caps
+        outputbuf = buf.make_writable()
+        try:
+            if boxes.set_track_id(outputbuf, tid):
+                return outputbuf
+        except (ValueError, TypeError), e:
+            self.debug("Could not patch the track id in place: %s", e)
+        return self._rewrite_trak_id(buf, tid)
+
+    def _rewrite_trak_id(self, buf, tid):
         f = StringIO(buf.data)
         al = list(atoms.read_atoms(f))
         ad = atoms.atoms_dict(al)
@@ -144,31 +213,142 @@ class FMP4Aggregator(feedcomponent.ParseLaunchComponent):
         outputbuf.caps = self._outputcaps
         return outputbuf
 
-    def _push_buffer(self, buf):
+    def _queue_buffer(self, buf):
+        # called with the lock held, buffers are pushed by _push_pending
+        # once it is released
         buf.set_caps(self._outputcaps)
+        self._outgoing.append(buf)
+
+    def _push_buffer(self, buf):
         self._appsrc.emit('push-buffer', buf)
         self.debug("Forwarding buffer ts:%s duration:%s",
                    gst.TIME_ARGS(buf.timestamp), gst.TIME_ARGS(buf.duration))
 
+    def _push_pending(self):
+        # called without the lock, since the appsrc blocks while downstream
+        # does not take the buffers. The other sinks wait for the push lock
+        # and keep the order in which the buffers were queued
+        self._pushLock.acquire()
+        try:
+            while True:
+                self._lock.acquire()
+                try:
+                    if not self._outgoing:
+                        return
+                    buf = self._outgoing.popleft()
+                finally:
+                    self._lock.release()
+                self._push_buffer(buf)
+        finally:
+            self._pushLock.release()
+
+    def _flush(self):
+        # called with the lock held, queues the fragments to push in
+        # timestamp order while every sink has one or the oldest one has
+        # waited for too long
+        if not self._all_sinks_prerolled():
+            return
+        while True:
+            heads = [(d['queue'][0].timestamp, d['id'], d)
+                     for d in self._sinks.values() if d['queue']]
+            if not heads:
+                return
+            timestamp, tid, appsinkd = min(heads)
+            waiting = [d for d in self._sinks.values() if not d['queue']]
+            if waiting:
+                newest = max([d['queue'][-1].timestamp
+                              for d in self._sinks.values() if d['queue']])
+                if newest - timestamp < self._maxQueueDuration:
+                    return
+                for d in waiting:
+                    d['late'] += 1
+            self._lastPushed = timestamp
+            self._queue_buffer(appsinkd['queue'].popleft())
+
+    def _trim(self, appsinkd):
+        # called with the lock held, bounds a queue that is not flushed
+        # because the other sinks did not preroll yet
+        queue = appsinkd['queue']
+        while queue and \
+                queue[-1].timestamp - queue[0].timestamp > \
+                self._maxQueueDuration:
+            queue.popleft()
+            appsinkd['dropped'] += 1
+
+    def _headers_received(self, appsinkd, buf):
+        # called with the lock held, for the first moov of a sink and the
+        # ones it sends when its input restarts
+        stsd = boxes.get_sample_description(buf.data)
+        if appsinkd['got_headers'] and stsd == appsinkd['stsd']:
+            self.info("Input %s restarted with the same codec "
+                      "configuration, resuming it", appsinkd['name'])
+            return
+        prerolled = self._all_sinks_prerolled()
+        if not self._parse_headers(buf, appsinkd['id']):
+            # keep the previous track of a restarted input
+            return
+        appsinkd['stsd'] = stsd
+        if appsinkd['got_headers']:
+            self.info("Input %s restarted with a new codec configuration",
+                      appsinkd['name'])
+        appsinkd['got_headers'] = True
+        if self._all_sinks_prerolled():
+            self.info("Pushing moov downstream")
+            self._queue_buffer(self._streamheaders)
+            if not prerolled:
+                self._flush()
+
+    ### START OF THREAD-AWARE CODE (called from non-reactor threads)
+
     def _new_preroll(self, appsink):
         self.debug("new preroll buffer")
         buf = appsink.emit('pull-preroll')
-        appsinkd = self._sinks[appsink]
-        # parse the moov
-        if buf.flag_is_set(gst.BUFFER_FLAG_IN_CAPS):
-            appsinkd['got_headers'] = self._parse_headers(buf, appsinkd['id'])
-        if self._all_sinks_prerolled():
-            self.info("Pushing moov downstream")
-            self._push_buffer(self._streamheaders)
+        if not buf.flag_is_set(gst.BUFFER_FLAG_IN_CAPS):
+            return
+        self._sinks[appsink]['preroll'] = buf
+        self._lock.acquire()
+        try:
+            self._headers_received(self._sinks[appsink], buf)
+        finally:
+            self._lock.release()
+        self._push_pending()
 
     def _new_buffer(self, appsink):
         self.debug("new buffer")
         buf = appsink.emit('pull-buffer')
+        appsinkd = self._sinks[appsink]
+        # appsink hands the preroll buffer again as the first one
+        preroll, appsinkd['preroll'] = appsinkd['preroll'], None
 
-        # discard moov, already parsed in preroll
+        # a moov after the preroll comes from a restarted input
         if buf.flag_is_set(gst.BUFFER_FLAG_IN_CAPS):
+            if preroll is not None and buf.data == preroll.data:
+                return True
+            self._lock.acquire()
+            try:
+                self._headers_received(appsinkd, buf)
+            finally:
+                self._lock.release()
+            self._push_pending()
             return True
 
-        # and finally send the current buffer downstream
-        outputbuf = self._update_trak_id(buf, self._sinks[appsink]['id'])
-        self._push_buffer(outputbuf)
+        outputbuf = self._update_trak_id(buf, appsinkd['id'])
+        self._lock.acquire()
+        try:
+            if buf.timestamp == gst.CLOCK_TIME_NONE:
+                # can't be ordered, send it downstream as it is
+                self._queue_buffer(outputbuf)
+            elif self._lastPushed is not None and \
+                    buf.timestamp < self._lastPushed:
+                self.debug("Dropping late buffer ts:%s from %s",
+                           gst.TIME_ARGS(buf.timestamp), appsinkd['name'])
+                appsinkd['dropped'] += 1
+            else:
+                appsinkd['queue'].append(outputbuf)
+                self._flush()
+                self._trim(appsinkd)
+        finally:
+            self._lock.release()
+        self._push_pending()
+
+    ### END OF THREAD-AWARE CODE
@@ -0,0 +1,188 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import struct
+
+# Helpers to walk ISO base media boxes by their headers only, without
+# building the atom trees mp4seek does.
+
+TFHD_PATH = ('moof', 'traf', 'tfhd')
+STSD_PATH = ('moov', 'trak', 'mdia', 'minf', 'stbl', 'stsd')
+
+
+def iter_boxes(data, offset=0, end=None):
+    """
+    Iterate over the boxes found in data[offset:end].
+
+    @returns: iterator of (type, offset, header size, size)
+    """
+    if end is None:
+        end = len(data)
+    while offset + 8 <= end:
+        size, type = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            size, = struct.unpack_from('>Q', data, offset + 8)
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise ValueError("truncated %r box at offset %d" % (type, offset))
+        yield type, offset, header, size
+        offset += size
+
+
+def find_box(data, path, offset=0, end=None):
+    """
+    Find the first box matching a path of box types, like
+    ('moof', 'traf', 'tfhd').
+
+    @returns: (offset, header size, size) or None
+    """
+    for type, off, header, size in iter_boxes(data, offset, end):
+        if type == path[0]:
+            if len(path) == 1:
+                return off, header, size
+            return find_box(data, path[1:], off + header, off + size)
+    return None
+
+
+def get_track_id_offset(data):
+    """
+    Returns the offset of the track id in the tfhd box of a fragment, or
+    None if data is not a fragment.
+    """
+    box = find_box(data, TFHD_PATH)
+    if box is None:
+        return None
+    offset, header, size = box
+    if size < header + 8:
+        raise ValueError("truncated tfhd box at offset %d" % offset)
+    # skip the version and flags of the full box
+    return offset + header + 4
+
+
+def get_track_id(data):
+    """
+    Returns the track id of the tfhd box of a fragment, or None if data is
+    not a fragment.
+    """
+    offset = get_track_id_offset(data)
+    if offset is None:
+        return None
+    return struct.unpack_from('>I', data, offset)[0]
+
+
+def set_track_id(data, track_id):
+    """
+    Overwrite the track id of the tfhd box of a fragment in data, which
+    must be a writable buffer.
+
+    @returns: whether data is a fragment
+    """
+    offset = get_track_id_offset(data)
+    if offset is None:
+        return False
+    struct.pack_into('>I', data, offset, track_id)
+    return True
+
+
+TFXD_UUID = '6d1d9b0542d544e680e2141daff757b2'.decode('hex')
+TRAF_PATH = ('moof', 'traf')
+TRUN_DATA_OFFSET_PRESENT = 0x1
+
+
+def get_fragment_time(data):
+    """
+    Returns the timestamp and duration of a live smooth streaming fragment,
+    from its tfxd uuid box.
+
+    @rtype: tuple of (int, int), or None if the fragment has no tfxd box
+    """
+    traf = find_box(data, TRAF_PATH)
+    if traf is None:
+        return None
+    offset, header, size = traf
+    for type, off, h, s in iter_boxes(data, offset + header, offset + size):
+        if type != 'uuid' or data[off + h:off + h + 16] != TFXD_UUID:
+            continue
+        version = ord(data[off + h + 16])
+        if version == 1:
+            return struct.unpack_from('>QQ', data, off + h + 20)
+        return struct.unpack_from('>II', data, off + h + 20)
+    return None
+
+
+def iter_data_offsets(data):
+    """
+    Iterate over the positions of the data offsets of the trun boxes of a
+    fragment, for the ones that have it.
+    """
+    traf = find_box(data, TRAF_PATH)
+    if traf is None:
+        return
+    offset, header, size = traf
+    for type, off, h, s in iter_boxes(data, offset + header, offset + size):
+        if type != 'trun':
+            continue
+        flags, = struct.unpack_from('>I', data, off + h)
+        if flags & TRUN_DATA_OFFSET_PRESENT:
+            # after the version, flags and sample count
+            yield off + h + 8
+
+
+def move_data_offsets(original, moof):
+    """
+    Set the data offsets of the trun boxes of moof, a rewritten version of
+    the moof of original, to the ones in original moved by the size the
+    moof grew.
+
+    @returns: the patched moof
+    @rtype:   str
+    """
+    shift = len(moof) - get_moof_size(original)
+    patched = bytearray(moof)
+    for src, dst in zip(iter_data_offsets(original),
+                        iter_data_offsets(moof)):
+        value, = struct.unpack_from('>i', original, src)
+        struct.pack_into('>i', patched, dst, value + shift)
+    return str(patched)
+
+
+def get_moof_size(data):
+    """
+    Returns the size of the moof box a fragment starts with, or 0.
+    """
+    for type, offset, header, size in iter_boxes(data):
+        if type == 'moof':
+            return size
+        break
+    return 0
+
+
+def get_sample_description(data):
+    """
+    Returns the stsd box of the first track of a moov, with the codec
+    configuration, or None if data has no moov.
+
+    @rtype: str
+    """
+    box = find_box(data, STSD_PATH)
+    if box is None:
+        return None
+    offset, header, size = box
+    return data[offset:offset + size]
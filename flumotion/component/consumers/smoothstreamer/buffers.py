@@ -0,0 +1,97 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# The data of a stored fragment is a list of parts written one after the
+# other. Parts are strings, buffers of strings, or objects with a length
+# and a read(start, end) method, like disktier.DiskPart.
+
+CHUNK_SIZE = 64 * 1024
+# parts sliced into strings
+_STRINGS = (str, buffer)
+
+
+def parts_size(parts):
+    return sum([len(p) for p in parts])
+
+
+class View(object):
+    """
+    A length-bounded view of a part, read without copying the part.
+    """
+
+    def __init__(self, part, offset, size):
+        self._part = part
+        self._offset = offset
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def read(self, start=0, end=None):
+        if end is None or end > self._size:
+            end = self._size
+        start += self._offset
+        end += self._offset
+        if isinstance(self._part, _STRINGS):
+            return self._part[start:end]
+        return self._part.read(start, end)
+
+
+def prefix(parts, size):
+    """
+    Returns the parts holding the first size bytes of parts, the last one
+    bounded by a L{View} if needed.
+    """
+    result = []
+    for part in parts:
+        if size <= 0:
+            break
+        if len(part) <= size:
+            result.append(part)
+        else:
+            result.append(View(part, 0, size))
+        size -= len(part)
+    return result
+
+
+def iter_chunks(parts, start=0, end=None, chunk_size=CHUNK_SIZE):
+    """
+    Iterate over the data of parts, from byte start to end (excluded), as
+    strings of at most chunk_size bytes. String parts no bigger than that
+    are returned whole when in the range.
+    """
+    offset = 0
+    for part in parts:
+        size = len(part)
+        first = max(start - offset, 0)
+        last = size
+        if end is not None:
+            last = min(end - offset, size)
+        offset += size
+        if first >= last:
+            if end is not None and offset >= end:
+                break
+            continue
+        if isinstance(part, str) and first == 0 and last == size \
+           and size <= chunk_size:
+            yield part
+            continue
+        for o in xrange(first, last, chunk_size):
+            if isinstance(part, _STRINGS):
+                yield part[o:min(o + chunk_size, last)]
+            else:
+                yield part.read(o, min(o + chunk_size, last))
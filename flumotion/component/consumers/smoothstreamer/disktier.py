@@ -0,0 +1,193 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import mmap
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, threads
+
+from flumotion.common import log
+
+__version__ = "$Rev$"
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class DiskPart(object):
+    """
+    A part of a fragment written in a segment file.
+    """
+
+    def __init__(self, segment, offset, size):
+        self.segment = segment
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def read(self, start=0, end=None):
+        if end is None or end > self.size:
+            end = self.size
+        return self.segment.read(self.offset + start, end - start)
+
+
+class Segment(log.Loggable):
+    """
+    I am an append-only file holding the data of demoted fragments, which
+    is read back through a memory map. I remove myself once I'm full and
+    none of my fragments is used anymore.
+    """
+
+    logCategory = 'disk-segment'
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.reserved = 0 # bytes of the writes scheduled so far
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+        self._map = None
+        self._refcount = 0
+        self._sealed = False
+
+    def write(self, data):
+        offset = self.size
+        while data:
+            written = os.write(self._fd, data)
+            data = data[written:]
+            self.size += written
+        return offset
+
+    def read(self, offset, size):
+        if self._map is None or len(self._map) < offset + size:
+            # the file grew since it was mapped
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._fd, self.size,
+                                  access=mmap.ACCESS_READ)
+        return self._map[offset:offset + size]
+
+    def ref(self):
+        self._refcount += 1
+
+    def unref(self):
+        self._refcount -= 1
+        if self._refcount == 0 and self._sealed:
+            self.close()
+
+    def seal(self):
+        self._sealed = True
+        if self._refcount == 0:
+            self.close()
+
+    def close(self):
+        if self._fd is None:
+            return
+        self.debug("removing segment %s", self.path)
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        os.close(self._fd)
+        self._fd = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            # already removed with the directory of the store
+            pass
+
+
+class SegmentStore(log.Loggable):
+    """
+    I write fragments in a sequence of segment files, in a private
+    directory.
+    """
+
+    logCategory = 'disk-tier'
+
+    def __init__(self, directory, segmentSize=DEFAULT_SEGMENT_SIZE):
+        self._directory = tempfile.mkdtemp(prefix='smoothstreamer-',
+                                           dir=directory)
+        self._segmentSize = segmentSize
+        self._segment = None
+        self._count = 0
+        self._writing = defer.DeferredLock()
+
+    def _reserve(self, parts):
+        if self._segment is None or \
+                self._segment.reserved >= self._segmentSize:
+            self._rotate()
+        self._segment.reserved += sum([len(p) for p in parts])
+        return self._segment
+
+    def write(self, parts):
+        """
+        @param parts: strings to write
+        @returns: a L{DiskPart} for each string
+        """
+        segment = self._reserve(parts)
+        written = []
+        for p in parts:
+            written.append(DiskPart(segment, segment.write(p), len(p)))
+            segment.ref()
+        return written
+
+    def writeInThread(self, parts):
+        """
+        Like L{write}, but the strings are written by a thread of the
+        reactor pool, one call after the other, so the reactor does not
+        wait for the disk.
+
+        @returns: a deferred fired with a L{DiskPart} for each string
+        """
+        segment = self._reserve(parts)
+        # keep the segment while it is written
+        segment.ref()
+
+        def write():
+            return [(segment.write(p), len(p)) for p in parts]
+
+        def written(offsets):
+            parts = []
+            for offset, size in offsets:
+                parts.append(DiskPart(segment, offset, size))
+                segment.ref()
+            return parts
+
+        d = self._writing.run(threads.deferToThread, write)
+        d.addCallback(written)
+        d.addBoth(self._unref, segment)
+        return d
+
+    def _unref(self, result, segment):
+        segment.unref()
+        return result
+
+    def close(self):
+        if self._segment is not None:
+            self._segment.seal()
+            self._segment = None
+        shutil.rmtree(self._directory, True)
+
+    def _rotate(self):
+        if self._segment is not None:
+            self._segment.seal()
+        path = os.path.join(self._directory, 'segment-%08d' % self._count)
+        self._count += 1
+        self.debug("starting segment %s", path)
+        self._segment = Segment(path)
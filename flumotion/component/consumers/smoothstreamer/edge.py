@@ -0,0 +1,369 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import time
+from xml.dom import minidom
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.python import failure
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+from flumotion.common import log
+from flumotion.component.common.streamer.fragmentedresource import\
+    FragmentNotFound
+from flumotion.component.consumers.smoothstreamer import boxes
+from flumotion.component.consumers.smoothstreamer.resources import\
+    MANIFEST_NAME
+from flumotion.component.consumers.smoothstreamer.smoothstreamer import\
+    Fragment, FragmentStore
+
+__version__ = "$Rev$"
+
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_CONNECTIONS = 4
+DEFAULT_TIMESCALE = 10000000
+# how long a fragment the upstream doesn't have is not asked again
+MISSING_TIMEOUT = 1.0
+# the attributes of the upstream manifest copied to the streams and the
+# qualities, with their types
+STREAM_ATTRIBUTES = {'SubType': str, 'Name': str, 'Url': str,
+                     'Language': str, 'MaxWidth': int, 'MaxHeight': int,
+                     'DisplayWidth': int, 'DisplayHeight': int}
+QUALITY_ATTRIBUTES = {'FourCC': str, 'CodecPrivateData': str,
+                      'MaxWidth': int, 'MaxHeight': int,
+                      'SamplingRate': int, 'Channels': int,
+                      'BitsPerSample': int, 'PacketSize': int,
+                      'AudioTag': int, 'NALUnitLengthField': int}
+
+
+class UpstreamError(Exception):
+
+    def __init__(self, code, path):
+        Exception.__init__(self, "upstream replied %s to %s" % (code, path))
+        self.code = code
+
+
+class _BodyReceiver(protocol.Protocol):
+
+    def __init__(self, d):
+        self._d = d
+        self._data = []
+
+    def dataReceived(self, data):
+        self._data.append(data)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self._d.callback(''.join(self._data))
+        else:
+            self._d.errback(reason)
+
+
+class HTTPFetcher(log.Loggable):
+    """
+    I get resources from an upstream server over a pool of persistent
+    connections. Concurrent fetches of the same resource share a single
+    upstream request.
+    """
+
+    logCategory = 'edge-fetcher'
+
+    def __init__(self, url, connections=DEFAULT_CONNECTIONS):
+        """
+        @param url: url of the mount point of the upstream origin
+        """
+        if not url.endswith('/'):
+            url += '/'
+        self._url = url
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = connections
+        self._agent = Agent(reactor, pool=self._pool)
+        self._inflight = {} # path -> list of deferreds
+        self.requests = 0
+
+    def fetch(self, path):
+        """
+        @param path: path relative to the upstream mount point
+        @returns: a deferred fired with the body of the resource, or
+                  failed with an L{UpstreamError}
+        """
+        waiters = self._inflight.get(path)
+        if waiters is None:
+            waiters = self._inflight[path] = []
+            self.requests += 1
+            d = self._agent.request('GET', self._url + path,
+                                    Headers({'User-Agent': ['flumotion']}))
+            d.addCallback(self._gotResponse, path)
+            d.addBoth(self._fetched, path)
+        d = defer.Deferred()
+        waiters.append(d)
+        return d
+
+    def _gotResponse(self, response, path):
+        d = defer.Deferred()
+        response.deliverBody(_BodyReceiver(d))
+        if response.code != 200:
+            # read it anyway, to keep the connection
+            d.addCallback(lambda _: failure.Failure(
+                UpstreamError(response.code, path)))
+        return d
+
+    def _fetched(self, result, path):
+        for d in self._inflight.pop(path):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def close(self):
+        return self._pool.closeCachedConnections()
+
+
+class EdgeStore(FragmentStore):
+    """
+    I am a fragment store filled from an upstream smooth streaming origin.
+    I poll its manifest, copy its streams and qualities and prefetch the
+    fragments in my DVR window. Fragments that are asked before they are
+    prefetched are fetched on demand, the requests for them wait with the
+    fragment-wait-timeout of the resource.
+    """
+
+    logCategory = 'edge-store'
+
+    def __init__(self, fetcher):
+        FragmentStore.__init__(self)
+        self._fetcher = fetcher
+        self._manifest = None
+        self._poll = None
+        self._missing = {} # path -> time the upstream didn't have it
+        self._announced = {} # type -> (timestamps of the chunks, last, end)
+
+    def start(self, interval=DEFAULT_POLL_INTERVAL):
+        self._poll = task.LoopingCall(self.pollManifest)
+        self._poll.start(interval)
+
+    def close(self):
+        if self._poll and self._poll.running:
+            self._poll.stop()
+        FragmentStore.close(self)
+        return self._fetcher.close()
+
+    def isReady(self):
+        return self.prerolled()
+
+    def prerolled(self):
+        # the upstream window might be shorter than ours
+        if not self._qualities:
+            return False
+        for q in self._qualities.values():
+            if q.getFragmentCount() == 0:
+                return False
+        return True
+
+    def pollManifest(self):
+        """
+        @returns: a deferred fired once the new fragments are prefetched
+        """
+        d = self._fetcher.fetch(MANIFEST_NAME)
+        d.addCallback(self._manifestReceived)
+        d.addErrback(lambda f: self.warning("Could not get the manifest: %s",
+                                            f.getErrorMessage()))
+        return d
+
+    def _manifestReceived(self, manifest):
+        if manifest == self._manifest:
+            return
+        self._manifest = manifest
+        root = minidom.parseString(manifest).documentElement
+        timescale = int(root.getAttribute('TimeScale') or DEFAULT_TIMESCALE)
+        if self.DVRWindowLength == 0:
+            self.TimeScale = timescale
+            self.DVRWindowLength = self._dvr_window_length_sec * timescale
+        count = root.getAttribute('LookAheadFragmentCount')
+        if count:
+            self.LookAheadFragmentCount = int(count)
+
+        dl = []
+        for si in root.getElementsByTagName('StreamIndex'):
+            stream = self._updateStream(si, timescale)
+            chunks = self._parseChunks(si)
+            if not chunks:
+                continue
+            last, duration = chunks[-1]
+            # fragments after the last chunk are announced by the previous
+            # ones, up to the lookahead
+            self._announced[stream.Type] = (
+                set([t for t, d in chunks]), last,
+                last + (duration or 0) * self.LookAheadFragmentCount)
+            since = chunks[-1][0] - self.DVRWindowLength
+            for ql in si.getElementsByTagName('QualityLevel'):
+                q = self._updateQuality(stream, ql)
+                for t, d in chunks:
+                    if t >= since and not q.getFragment(t):
+                        dl.append(self._prefetch(q, t, d))
+        self.invalidateManifest()
+        return defer.DeferredList(dl)
+
+    def _updateStream(self, si, timescale):
+        type = str(si.getAttribute('Type'))
+        stream = self.getStream(type,
+            int(si.getAttribute('TimeScale') or timescale))
+        self._copyAttributes(stream, si, STREAM_ATTRIBUTES)
+        return stream
+
+    def _updateQuality(self, stream, ql):
+        q = stream.getQuality(self, int(ql.getAttribute('Bitrate')))
+        if q.getStream() is None:
+            q.setStream(stream)
+            q.setTrackId(len(self._qualities) + 1)
+            self._qualities[('upstream', q.getTrackId())] = q
+        self._copyAttributes(q, ql, QUALITY_ATTRIBUTES)
+        return q
+
+    def _copyAttributes(self, obj, element, types):
+        for name, value in element.attributes.items():
+            name = str(name)
+            if name not in types:
+                continue
+            try:
+                setattr(obj, name, types[name](value))
+            except ValueError:
+                self.warning("Invalid %s attribute in the upstream "
+                             "manifest: %r", name, value)
+
+    def _parseChunks(self, si):
+        """
+        @returns: timestamp and duration of the chunks of a stream
+        @rtype:   list of (int, int), the duration is None if unknown
+        """
+        chunks = []
+        t = 0
+        for c in si.getElementsByTagName('c'):
+            if c.getAttribute('t'):
+                t = int(c.getAttribute('t'))
+            d = c.getAttribute('d')
+            d = d and int(d) or None
+            if chunks and chunks[-1][1] is None:
+                chunks[-1] = (chunks[-1][0], t - chunks[-1][0])
+            chunks.append((t, d))
+            if d:
+                t += d
+        if len(chunks) > 1 and chunks[-1][1] is None:
+            # until the fragment tells its duration
+            chunks[-1] = (chunks[-1][0], chunks[-2][1])
+        return chunks
+
+    def _prefetch(self, quality, timestamp, duration):
+        d = self._fetch(quality, timestamp, duration)
+        d.addErrback(lambda f: self.debug("Could not prefetch %d: %s",
+                                          timestamp, f.getErrorMessage()))
+        return d
+
+    def _fetch(self, quality, timestamp, duration=None):
+        path = quality.getFragmentPaths(timestamp)[0][0]
+        d = self._fetcher.fetch(path)
+        d.addCallback(self._publish, quality, timestamp, duration)
+
+        def missing(f):
+            if f.check(UpstreamError) and f.value.code == 404:
+                self._missing[path] = time.time()
+            return f
+        d.addErrback(missing)
+        return d
+
+    def _publish(self, data, quality, timestamp, duration):
+        if quality.getFragment(timestamp):
+            return
+        last = quality.getLastFragment()
+        if last and timestamp < last.timestamp - self.DVRWindowLength:
+            return
+        try:
+            timing = boxes.get_fragment_time(data)
+            infoSize = boxes.get_moof_size(data)
+        except ValueError, e:
+            self.warning("Could not parse fragment %d: %s", timestamp, e)
+            return
+        if timing:
+            duration = timing[1]
+        if duration is None:
+            duration = 0
+        quality.publishFragment(Fragment(timestamp, duration, [data],
+                                         infoSize))
+
+    def _getQuality(self, bitrate, type):
+        stream = self._streams.get(type)
+        if not stream:
+            return None
+        try:
+            return stream.getQuality(self, bitrate, False)
+        except ValueError:
+            return None
+
+    def _isAnnounced(self, type, time):
+        if type not in self._announced:
+            return False
+        timestamps, last, end = self._announced[type]
+        return time in timestamps or last < time <= end
+
+    def getFragment(self, bitrate, type, time, kind=None):
+        q = self._getQuality(bitrate, type)
+        if q is None:
+            raise FragmentNotFound(time)
+        try:
+            return FragmentStore.getFragment(self, bitrate, type, time, kind)
+        except FragmentNotFound:
+            if not self._isAnnounced(type, time) or \
+                    self._isMissing(q.getFragmentPaths(time)[0][0]):
+                raise
+            # the upstream might have it
+            return (None, None, 412)
+
+    def _isMissing(self, path):
+        t = self._missing.get(path)
+        if t is None:
+            return False
+        if time.time() - t < MISSING_TIMEOUT:
+            return True
+        del self._missing[path]
+        return False
+
+    def waitFragment(self, bitrate, type, time, timeout):
+        """
+        Fetch a fragment for which L{getFragment} returned 412.
+
+        @returns: a deferred fired once the fragment is published, or after
+                  timeout seconds
+        """
+        if self._getQuality(bitrate, type) is None or \
+                not self._isAnnounced(type, time):
+            # only the fragments of the upstream manifest are asked to it
+            return defer.succeed(None)
+        done = defer.Deferred()
+
+        def fetched(_):
+            if call.active():
+                call.cancel()
+                done.callback(None)
+        call = reactor.callLater(timeout, done.callback, None)
+        # concurrent misses share the same upstream request
+        d = self._fetch(self._getQuality(bitrate, type), time)
+        d.addErrback(lambda f: self.debug("Could not fetch %d: %s",
+                                          time, f.getErrorMessage()))
+        d.addCallback(fetched)
+        return done
@@ -0,0 +1,110 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import threading
+from collections import deque
+
+from twisted.internet import reactor
+
+from flumotion.common import log
+
+__version__ = "$Rev$"
+
+
+class HandoffQueue(log.Loggable):
+    """
+    I hand items over from the streaming threads to the reactor thread.
+
+    Items pushed while a drain is pending are added to the same batch, so
+    the reactor is only woken up once per batch instead of once per item.
+    """
+
+    logCategory = 'handoff-queue'
+
+    def __init__(self, callback):
+        """
+        @param callback: called in the reactor thread for every item, in
+                         the order they were pushed
+        """
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._items = deque()
+        self._scheduled = False
+        self._maxDepth = 0
+        self._batches = 0
+        self._drained = 0
+        self._maxBatch = 0
+
+    ### START OF THREAD-AWARE CODE (called from non-reactor threads)
+
+    def push(self, item):
+        self._lock.acquire()
+        try:
+            self._items.append(item)
+            self._maxDepth = max(self._maxDepth, len(self._items))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        finally:
+            self._lock.release()
+        reactor.callFromThread(self._drain)
+
+    def getDepth(self):
+        return len(self._items)
+
+    ### END OF THREAD-AWARE CODE
+
+    def _drain(self):
+        self._lock.acquire()
+        try:
+            items, self._items = self._items, deque()
+            self._scheduled = False
+        finally:
+            self._lock.release()
+        self._batches += 1
+        self._drained += len(items)
+        self._maxBatch = max(self._maxBatch, len(items))
+        for item in items:
+            # one failing item doesn't lose the rest of the batch
+            try:
+                self._callback(*item)
+            except Exception, e:
+                self.warning("Could not process a queued item: %s",
+                             log.getExceptionMessage(e))
+
+    def getStats(self):
+        """
+        Returns the queue statistics since the previous call: the current
+        and maximum number of queued items, the number of batches drained
+        and the mean and maximum batch size.
+
+        @rtype: dict of str -> number
+        """
+        self._lock.acquire()
+        try:
+            stats = {'depth': len(self._items),
+                     'max-depth': self._maxDepth,
+                     'batches': self._batches,
+                     'mean-batch': 0.0,
+                     'max-batch': self._maxBatch}
+            if self._batches:
+                stats['mean-batch'] = float(self._drained) / self._batches
+            self._maxDepth = len(self._items)
+            self._batches = self._drained = self._maxBatch = 0
+        finally:
+            self._lock.release()
+        return stats
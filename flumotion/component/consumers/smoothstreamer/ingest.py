@@ -0,0 +1,181 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from cStringIO import StringIO
+
+from mp4seek import atoms, iso
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
+
+from flumotion.component.consumers.smoothstreamer import boxes
+
+__version__ = "$Rev$"
+
+POOL_THREAD = 'thread'
+POOL_PROCESS = 'process'
+POOL_TYPES = (POOL_THREAD, POOL_PROCESS)
+
+
+def _add_live_boxes(moof, timestamp, duration, next):
+    extra = [iso.uuid_sscurrent.make(timestamp, duration),
+             iso.uuid_ssnext.make(next)]
+    # add live SS "uuid" boxes
+    moof.traf.uuid.extend(extra)
+    # make sure they are also written
+    moof.traf.add_extra_children(extra)
+
+
+def _write_moof(moof, data):
+    # the samples are moved by the size of the new boxes; the data offsets
+    # are patched in the written moof from the ones in data, so they are
+    # right whether or not mp4seek updates them
+    outf = StringIO()
+    iso.write_atoms([moof], outf)
+    return boxes.move_data_offsets(data, outf.getvalue())
+
+
+def make_live_fragment(data, timestamp, duration, next):
+    """
+    Add the live smooth streaming uuid boxes to a fmp4 fragment.
+
+    This is run by the ingest workers, so it must not use any state of the
+    store.
+
+    @param next: (timestamp, duration) of the fragments in the lookahead
+    @type  next: list of (int, int)
+    @returns: the fragment and the size of its moof
+    @rtype:   tuple of (str, int)
+    """
+    f = StringIO(data)
+    al = list(atoms.read_atoms(f))
+    ad = atoms.atoms_dict(al)
+    moof = iso.select_atoms(ad, ('moof', 1, 1))[0]
+    mdat = iso.select_atoms(ad, ('mdat', 1, 1))[0]
+    _add_live_boxes(moof, timestamp, duration, next)
+
+    # get the modified buffer back, the moof is its prefix
+    outf = StringIO()
+    outf.write(_write_moof(moof, data))
+    moofSize = outf.tell()
+    iso.write_atoms([mdat], outf)
+    return outf.getvalue(), moofSize
+
+
+def make_live_moof(data, timestamp, duration, next):
+    """
+    Like L{make_live_fragment}, but only the moof is written back. The mdat
+    is not serialized again and stays where it is in data, to be used
+    without copying it.
+
+    @returns: the moof, and the offset and size of the mdat in data
+    @rtype:   tuple of (str, int, int)
+    """
+    f = StringIO(data)
+    ad = atoms.atoms_dict(list(atoms.read_atoms(f)))
+    moof = iso.select_atoms(ad, ('moof', 1, 1))[0]
+    mdat = ad['mdat'][0]
+    _add_live_boxes(moof, timestamp, duration, next)
+    return _write_moof(moof, data), mdat.offset, mdat.size
+
+
+class InlinePool(object):
+    """
+    I run the ingest jobs synchronously, in the reactor thread.
+    """
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def submit(self, func, *args):
+        return defer.maybeDeferred(func, *args)
+
+
+class ThreadPool(object):
+    """
+    I run the ingest jobs in a pool of threads.
+    """
+
+    def __init__(self, workers):
+        self._pool = threadpool.ThreadPool(workers, workers,
+                                           'smooth-ingest')
+
+    def start(self):
+        self._pool.start()
+
+    def stop(self):
+        self._pool.stop()
+
+    def submit(self, func, *args):
+        return threads.deferToThreadPool(reactor, self._pool, func, *args)
+
+
+def _call(func, args):
+    # exceptions might not be picklable, send back their description
+    try:
+        return True, func(*args)
+    except Exception, e:
+        return False, '%s: %s' % (e.__class__.__name__, e)
+
+
+class ProcessPool(object):
+    """
+    I run the ingest jobs in a pool of processes. The jobs must be module
+    level functions and their arguments and results picklable.
+    """
+
+    def __init__(self, workers):
+        self._workers = workers
+        self._pool = None
+
+    def start(self):
+        import multiprocessing
+        self._pool = multiprocessing.Pool(self._workers)
+
+    def stop(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool = None
+
+    def submit(self, func, *args):
+        d = defer.Deferred()
+
+        def done((ok, result)):
+            # called from the result handler thread of the pool
+            if ok:
+                reactor.callFromThread(d.callback, result)
+            else:
+                reactor.callFromThread(d.errback, Exception(result))
+        self._pool.apply_async(_call, (func, args), callback=done)
+        return d
+
+
+def createPool(kind, workers):
+    """
+    @param kind:    L{POOL_THREAD} or L{POOL_PROCESS}
+    @param workers: number of workers, the jobs are run in the reactor
+                    thread if 0
+    """
+    if workers <= 0:
+        return InlinePool()
+    if kind == POOL_THREAD:
+        return ThreadPool(workers)
+    if kind == POOL_PROCESS:
+        return ProcessPool(workers)
+    raise ValueError("unknown ingest pool type %r" % kind)
@@ -16,7 +16,8 @@
 # Headers in this file shall remain intact.
 
 from flumotion.component.common.streamer import fragmentedresource as resources
-from twisted.internet import defer
+from flumotion.component.consumers.smoothstreamer import buffers
+from twisted.internet import defer, error, reactor
 from twisted.web import server
 try:
     from twisted.web import http
@@ -27,6 +28,8 @@ __version__ = "$Rev: $"
 
 XML_CONTENT_TYPE = "text/xml"
 MANIFEST_NAME = 'Manifest'
+DEFAULT_MAX_OUTSTANDING_BYTES = 256 * 1024
+DEFAULT_STALL_TIMEOUT = 30.0
 
 CLIENT_ACCESS_POLICY_NAME = "clientaccesspolicy.xml"
 CLIENT_ACCESS_POLICY = """
@@ -46,7 +49,329 @@ CLIENT_ACCESS_POLICY = """
 """
 
 
-class SmoothStreamingResource(resources.FragmentedResource):
+def parseAcceptEncoding(header):
+    """
+    Parse an Accept-Encoding header.
+
+    @returns: content-coding -> qvalue
+    @rtype:   dict of str -> float
+    """
+    codings = {}
+    for item in header.split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        codings[coding] = qvalue
+    return codings
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parseRange(header, size):
+    """
+    Parse the Range header of a request for an entity of size bytes. Only
+    single byte ranges are supported.
+
+    @returns: start and end (excluded) of the range, or None if the header
+              must be ignored
+    @rtype:   tuple of (int, int)
+    @raises RangeNotSatisfiable: if the range is out of the entity
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:
+            # suffix range, the last bytes of the entity
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable(header)
+            return max(size - length, 0), size
+        start = int(first)
+        end = size
+        if last:
+            end = int(last) + 1
+    except ValueError:
+        return None
+    if last and end <= start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    return start, min(end, size)
+
+
+def parseFragmentPath(resource):
+    """
+    Parse the path of a fragment, or fragment info, relative to the mount
+    point.
+
+    @returns: bitrate, stream type, timestamp and kind of the fragment
+    @rtype:   tuple of (str, str, int, str)
+    @raises resources.FragmentNotAvailable: if it isn't a fragment path
+    """
+    p = [c for c in resource.split('/') if c]
+    if len(p) >= 2 and p[0].startswith("QualityLevels("):
+        p[0] = p[0][14:-1]
+    else:
+        raise resources.FragmentNotAvailable("Invalid fragment request")
+
+    if p[1].startswith("FragmentInfo("):
+        p[1] = p[1][13:-1]
+        kind = "info"
+    elif p[1].startswith("Fragments("):
+        p[1] = p[1][10:-1]
+        kind = "fragment"
+    else:
+        raise resources.FragmentNotAvailable("Invalid fragment request")
+
+    try:
+        bitrate, (type, time) = p[0], p[1].split("=")
+        time = int(time)
+    except ValueError:
+        raise resources.FragmentNotAvailable("Invalid fragment request")
+    return bitrate, type, time, kind
+
+
+class ClientStalled(Exception):
+    pass
+
+
+class WriteStats(object):
+    """
+    Counters of the fragments written with a L{FragmentProducer}.
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.completed = 0
+        self.stalled = 0
+        self.lost = 0
+
+    def asDict(self):
+        return {'active': self.active, 'completed': self.completed,
+                'stalled': self.stalled, 'lost': self.lost}
+
+
+class FragmentProducer(object):
+    """
+    I write a fragment to a request in chunks, each time its transport has
+    sent what I wrote before, so no more than maxOutstanding bytes are
+    buffered per connection. Clients that don't read for stallTimeout
+    seconds are disconnected.
+    """
+
+    def __init__(self, request, chunks, stats,
+                 maxOutstanding=DEFAULT_MAX_OUTSTANDING_BYTES,
+                 stallTimeout=DEFAULT_STALL_TIMEOUT):
+        """
+        @param chunks: iterator of the strings to write
+        @type  stats:  L{WriteStats}
+        """
+        self.written = 0
+        self._request = request
+        self._chunks = chunks
+        self._stats = stats
+        self._maxOutstanding = maxOutstanding
+        self._stallTimeout = stallTimeout
+        self._stallCall = None
+        self._d = None
+
+    def start(self):
+        """
+        @returns: a deferred fired once everything is written, or failed
+                  if the client is gone or stalled
+        """
+        self._d = defer.Deferred()
+        self._stats.active += 1
+        self._request.registerProducer(self, False)
+        return self._d
+
+    def resumeProducing(self):
+        if self._d is None:
+            return
+        if self._stallCall:
+            self._stallCall.cancel()
+        self._stallCall = reactor.callLater(self._stallTimeout,
+                                            self._stalled)
+        sent = 0
+        while sent < self._maxOutstanding:
+            try:
+                chunk = self._chunks.next()
+            except StopIteration:
+                self._stats.completed += 1
+                self._end().callback(self.written)
+                return
+            self._request.write(chunk)
+            sent += len(chunk)
+            self.written += len(chunk)
+
+    def stopProducing(self):
+        # the connection was lost
+        if self._d is None:
+            return
+        self._stats.lost += 1
+        self._end().errback(error.ConnectionLost())
+
+    def _stalled(self):
+        self._stallCall = None
+        self._stats.stalled += 1
+        d = self._end()
+        self._request.transport.loseConnection()
+        d.errback(ClientStalled("no data read in %s seconds"
+                                % self._stallTimeout))
+
+    def _end(self):
+        d, self._d = self._d, None
+        self._stats.active -= 1
+        if self._stallCall:
+            self._stallCall.cancel()
+            self._stallCall = None
+        self._request.unregisterProducer()
+        return d
+
+
+class FragmentWriterMixin:
+    """
+    I write the manifest and the fragments of a store in the responses,
+    with their caching headers. I need a store, a _fragmentMaxAge, a
+    bytesSent counter, and a _writeStats, _maxOutstandingBytes and
+    _stallTimeout for the L{FragmentProducer}s.
+    """
+
+    def _negotiateManifestEncoding(self, request):
+        header = request.getHeader('accept-encoding')
+        if not header:
+            return None
+        codings = parseAcceptEncoding(header)
+        for e in self.store.getManifestEncodings():
+            if codings.get(e, codings.get('*', 0)) > 0:
+                return e
+        return None
+
+    def _writeManifestBody(self, request):
+        encoding = self._negotiateManifestEncoding(request)
+        manifest, etag = self.store.getManifest(encoding)
+        if self.store.getManifestEncodings():
+            request.setHeader('Vary', 'Accept-Encoding')
+        if encoding:
+            request.setHeader('Content-Encoding', encoding)
+        request.setHeader('Cache-Control',
+                          'public, max-age=%d' % self.store.getManifestMaxAge())
+        if request.setETag(etag) == http.CACHED:
+            self.debug('manifest not modified since %s', etag)
+        elif request.method == 'GET':
+            request.setHeader('content-length', len(manifest))
+            request.write(manifest)
+            self.bytesSent += len(manifest)
+        elif request.method == 'HEAD':
+            self.debug('handling HEAD request')
+
+    def _setFragmentCacheHeaders(self, request, fragment, kind):
+        # fragments never change once published
+        request.setHeader('Cache-Control', 'public, max-age=%d, immutable'
+                          % self._fragmentMaxAge)
+        etag = fragment.getETag(kind)
+        if request.getHeader('if-none-match'):
+            # If-Modified-Since is ignored when If-None-Match is present
+            request.setHeader('Last-Modified',
+                              http.datetimeToString(fragment.published))
+            return request.setETag(etag)
+        request.setETag(etag)
+        return request.setLastModified(fragment.published)
+
+    def _getFragmentRange(self, request, fragment, kind, size):
+        header = request.getHeader('range')
+        if not header:
+            return None
+        ifRange = request.getHeader('if-range')
+        if ifRange:
+            ifRange = ifRange.strip()
+            if ifRange.startswith('"') or ifRange.startswith('W/'):
+                if ifRange != fragment.getETag(kind):
+                    return None
+            else:
+                try:
+                    if http.stringToDatetime(ifRange) != fragment.published:
+                        return None
+                except ValueError:
+                    return None
+        return parseRange(header, size)
+
+    def _writeFragmentBody(self, request, fragment, kind):
+        """
+        @returns: a deferred fired once the body is written
+        """
+        if self._setFragmentCacheHeaders(request, fragment,
+                                         kind) == http.CACHED:
+            self.debug('fragment not modified')
+            return defer.succeed(None)
+        parts = fragment.getParts(kind)
+        size = buffers.parts_size(parts)
+        request.setHeader('Accept-Ranges', 'bytes')
+        try:
+            r = self._getFragmentRange(request, fragment, kind, size)
+        except RangeNotSatisfiable:
+            self.debug('range not satisfiable: %s',
+                       request.getHeader('range'))
+            request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            request.setHeader('Content-Range', 'bytes */%d' % size)
+            request.setHeader('content-length', 0)
+            return defer.succeed(None)
+        if r is None:
+            start, end = 0, size
+        else:
+            start, end = r
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.setHeader('Content-Range',
+                              'bytes %d-%d/%d' % (start, end - 1, size))
+        request.setHeader('content-length', end - start)
+        if request.method != 'GET':
+            return defer.succeed(None)
+        segments = fragment.refSegments()
+        producer = FragmentProducer(request,
+            buffers.iter_chunks(parts, start, end), self._writeStats,
+            self._maxOutstandingBytes, self._stallTimeout)
+
+        def written(result):
+            self.bytesSent += producer.written
+            for s in segments:
+                s.unref()
+            return result
+        d = producer.start()
+        d.addBoth(written)
+        return d
+
+    def getWriteStats(self):
+        return self._writeStats
+
+    def setWriteLimits(self, maxOutstandingBytes, stallTimeout):
+        """
+        @param maxOutstandingBytes: bytes of a fragment written to a
+                                    connection before the previous ones
+                                    are sent
+        @param stallTimeout:        seconds after which a client that
+                                    doesn't read is disconnected
+        """
+        self._maxOutstandingBytes = maxOutstandingBytes
+        self._stallTimeout = stallTimeout
+
+
+class SmoothStreamingResource(resources.FragmentedResource,
+                              FragmentWriterMixin):
 
     logCategory = 'smooth-streamer'
 
@@ -55,9 +380,28 @@ class SmoothStreamingResource(resources.FragmentedResource):
         @param streamer: L{SmoothHTTPLiveStreamer}
         """
         self.store = store
+        self._fragmentWaitTimeout = 0
+        self._fragmentMaxAge = 0
+        self._writeStats = WriteStats()
+        self._maxOutstandingBytes = DEFAULT_MAX_OUTSTANDING_BYTES
+        self._stallTimeout = DEFAULT_STALL_TIMEOUT
         resources.FragmentedResource.__init__(self, streamer, httpauth,
                 secretKey, sessionTimeout)
 
+    def setFragmentMaxAge(self, maxAge):
+        """
+        @param maxAge: how long caches can keep fragments (in seconds)
+        """
+        self._fragmentMaxAge = maxAge
+
+    def setFragmentWaitTimeout(self, timeout):
+        """
+        @param timeout: how long requests for fragments in the lookahead
+                        wait for them to be published (in seconds), or 0
+                        to reply 412 straight away
+        """
+        self._fragmentWaitTimeout = timeout
+
     def _renderClientAccessPolicy(self, res, request, resource):
         self._writeHeaders(request, XML_CONTENT_TYPE)
         if request.method == 'GET':
@@ -72,52 +416,63 @@ class SmoothStreamingResource(resources.FragmentedResource):
     def _renderManifest(self, res, request, resource):
         self.debug('_render(): asked for manifest %s', resource)
         self._writeHeaders(request, XML_CONTENT_TYPE)
+        # under 1.1, make sure to Close, we want clientaccesspolicy.xml
+        # to be served by http-server, when running with a porter.
+        request.setHeader('Connection', 'Close')
+        self._writeManifestBody(request)
         if request.method == 'GET':
-            manifest = self.store.renderManifest()
-            request.setHeader('content-length', len(manifest))
-            # under 1.1, make sure to Close, we want clientaccesspolicy.xml
-            # to be served by http-server, when running with a porter.
-            request.setHeader('Connection', 'Close')
-            request.write(manifest)
-            self.bytesSent += len(manifest)
             self._logWrite(request)
-        elif request.method == 'HEAD':
-            self.debug('handling HEAD request')
         request.finish()
         return res
 
     def _renderFragment(self, res, request, resource):
-        p = [c for c in resource.split('/') if c]
-        if len(p) != 0 and p[0].startswith("QualityLevels("):
-            p[0] = p[0][14:-1]
-        else:
-            raise resources.FragmentNotAvailable("Invalid fragment request")
-
-        if p[1].startswith("FragmentInfo("):
-            p[1] = p[1][13:-1]
-            kind = "info"
-        elif p[1].startswith("Fragments("):
-            p[1] = p[1][10:-1]
-            kind = "fragment"
-        else:
-            raise resources.FragmentNotAvailable("Invalid fragment request")
+        published = self.store.lookup(resource)
+        if published:
+            fragment, kind, mime = published
+            self._writeFragment(request, fragment, kind, mime, 200)
+            return res
 
-        try:
-            bitrate, (type, time) = p[0], p[1].split("=")
-            time = int(time)
-        except ValueError:
-            raise resources.FragmentNotAvailable("Invalid fragment request")
+        # not published yet, or not the canonical path of a fragment
+        bitrate, type, time, kind = parseFragmentPath(resource)
+        fragment, mime, code = self.store.getFragment(bitrate, type, time,
+                                                      kind)
+        if code == 412 and self._fragmentWaitTimeout > 0:
+            # hold the request until the fragment is published
+            disconnected = []
+            request.notifyFinish().addErrback(disconnected.append)
+            d = self.store.waitFragment(bitrate, type, time,
+                                        self._fragmentWaitTimeout)
+            d.addCallback(self._renderWaitedFragment, request, disconnected,
+                          bitrate, type, time, kind)
+            d.addCallback(lambda _: res)
+            return d
+        self._writeFragment(request, fragment, kind, mime, code)
+        return res
 
+    def _renderWaitedFragment(self, _, request, disconnected,
+                              bitrate, type, time, kind):
+        if disconnected:
+            self.debug('client left while waiting for fragment %r', time)
+            return
         fragment, mime, code = self.store.getFragment(bitrate, type, time,
                                                       kind)
+        self._writeFragment(request, fragment, kind, mime, code)
+
+    def _writeFragment(self, request, fragment, kind, mime, code):
         self._writeHeaders(request, mime, code)
-        if request.method == 'GET' and code == 200:
-            request.setHeader('content-length', len(fragment))
-            request.write(fragment)
-            self.bytesSent += len(fragment)
+        d = defer.succeed(None)
+        if code == 200:
+            d = self._writeFragmentBody(request, fragment, kind)
+        d.addCallbacks(self._fragmentWritten, self._fragmentNotWritten,
+                       callbackArgs=(request, ), errbackArgs=(request, ))
+
+    def _fragmentWritten(self, _, request):
         self._logWrite(request)
         request.finish()
-        return res
+
+    def _fragmentNotWritten(self, failure, request):
+        self.debug('fragment not written: %s', failure.getErrorMessage())
+        self._logWrite(request)
 
     def _renderError(self, res, request, resource):
         request.write(self._errorMessage(request, http.NOT_FOUND))
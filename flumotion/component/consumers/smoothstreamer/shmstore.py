@@ -0,0 +1,474 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import marshal
+import mmap
+import os
+import struct
+import time
+
+from twisted.internet import defer, reactor
+
+from flumotion.common import log
+from flumotion.component.common.streamer.fragmentedresource import\
+    FragmentNotFound
+from flumotion.component.consumers.smoothstreamer import buffers
+
+__version__ = "$Rev$"
+
+MAGIC = 'SMOOTHSH'
+VERSION = 1
+# magic, version, index slot size, data size, index sequence, bytes written
+HEADER = struct.Struct('>8sIIQQQ')
+SEQ = struct.Struct('>Q')
+SEQ_OFFSET = 24
+WRITTEN_OFFSET = 32
+LENGTH = struct.Struct('>I')
+
+DEFAULT_DATA_SIZE = 256 * 1024 * 1024
+DEFAULT_SLOT_SIZE = 4 * 1024 * 1024
+READ_RETRIES = 100
+REATTACH_INTERVAL = 1.0
+WAIT_POLL_INTERVAL = 0.05
+
+MODE_PUBLISH = 'publish'
+MODE_ATTACH = 'attach'
+MODES = (MODE_PUBLISH, MODE_ATTACH)
+
+if os.path.isdir('/dev/shm'):
+    SHM_DIRECTORY = '/dev/shm'
+else:
+    import tempfile
+    SHM_DIRECTORY = tempfile.gettempdir()
+
+
+def region_path(name):
+    """
+    Returns the path of the region named name, shared by the streamers of
+    the host.
+    """
+    return os.path.join(SHM_DIRECTORY, 'smoothstreamer-' + name)
+
+
+class SharedRegion(object):
+    """
+    I am a memory-mapped file, shared by one writer and many readers.
+
+    I hold a ring of data, where the writer appends fragments and
+    manifests, and an index describing them. The index is written in two
+    alternating slots and published by incrementing a sequence number, so
+    readers check that the sequence didn't change while they read it.
+    Data is addressed by its absolute offset, the number of bytes written
+    before it; readers check that the ring didn't wrap over it while they
+    copied it.
+    """
+
+    def __init__(self, path, create=False, dataSize=DEFAULT_DATA_SIZE,
+                 slotSize=DEFAULT_SLOT_SIZE):
+        """
+        @param create: create the region at path, or attach to the
+                       existing one otherwise
+        """
+        self.path = path
+        self._owner = create
+        if create:
+            # readers of a previous region keep their mapping of it
+            if os.path.exists(path):
+                os.unlink(path)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0644)
+            try:
+                os.ftruncate(fd, HEADER.size + 2 * slotSize + dataSize)
+                self._map = mmap.mmap(fd, 0)
+                self.inode = os.fstat(fd).st_ino
+            finally:
+                os.close(fd)
+            self._map[:HEADER.size] = HEADER.pack(MAGIC, VERSION, slotSize,
+                                                  dataSize, 0, 0)
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                self.inode = os.fstat(fd).st_ino
+            finally:
+                os.close(fd)
+            magic, version, slotSize, dataSize, _, _ = \
+                HEADER.unpack(self._map[:HEADER.size])
+            if magic != MAGIC or version != VERSION:
+                self._map.close()
+                raise ValueError("%s is not a shared fragment store" % path)
+        self.slotSize = slotSize
+        self.dataSize = dataSize
+        self._dataOffset = HEADER.size + 2 * slotSize
+
+    def _get(self, offset):
+        return SEQ.unpack(self._map[offset:offset + SEQ.size])[0]
+
+    def _set(self, offset, value):
+        self._map[offset:offset + SEQ.size] = SEQ.pack(value)
+
+    def getSeq(self):
+        return self._get(SEQ_OFFSET)
+
+    def getWritten(self):
+        return self._get(WRITTEN_OFFSET)
+
+    def _slot(self, seq):
+        return HEADER.size + (seq % 2) * self.slotSize
+
+    def writeIndex(self, data):
+        """
+        Publish a new index.
+
+        @raises ValueError: if data doesn't fit in an index slot
+        """
+        if LENGTH.size + len(data) > self.slotSize:
+            raise ValueError("index of %d bytes is too big" % len(data))
+        seq = self.getSeq() + 1
+        # readers use the other slot until seq is incremented
+        o = self._slot(seq)
+        self._map[o:o + LENGTH.size + len(data)] = \
+            LENGTH.pack(len(data)) + data
+        self._set(SEQ_OFFSET, seq)
+
+    def readIndex(self):
+        """
+        @returns: the sequence number and data of the index, or None if
+                  it kept changing while it was read
+        @rtype:   tuple of (int, str)
+        """
+        for i in xrange(READ_RETRIES):
+            seq = self.getSeq()
+            o = self._slot(seq)
+            size = LENGTH.unpack(self._map[o:o + LENGTH.size])[0]
+            if size <= self.slotSize - LENGTH.size:
+                o += LENGTH.size
+                data = self._map[o:o + size]
+                if self.getSeq() == seq:
+                    return seq, data
+        return None
+
+    def writeData(self, parts, size):
+        """
+        Append parts to the ring.
+
+        @returns: the absolute offset of the data, or None if it doesn't
+                  fit in the ring
+        """
+        if size > self.dataSize:
+            return None
+        written = self.getWritten()
+        pos = written % self.dataSize
+        if pos + size > self.dataSize:
+            # data never wraps around the end of the ring
+            written += self.dataSize - pos
+            pos = 0
+        # invalidate what's overwritten before writing over it
+        self._set(WRITTEN_OFFSET, written + size)
+        o = self._dataOffset + pos
+        for chunk in buffers.iter_chunks(parts):
+            self._map[o:o + len(chunk)] = chunk
+            o += len(chunk)
+        return written
+
+    def isValid(self, offset, size):
+        # written, and not overwritten since
+        written = self.getWritten()
+        return offset + size <= written and \
+            written - offset <= self.dataSize
+
+    def readData(self, offset, size):
+        """
+        @returns: a copy of the data at offset, or None if it was
+                  overwritten
+        """
+        if not self.isValid(offset, size):
+            return None
+        o = self._dataOffset + offset % self.dataSize
+        data = self._map[o:o + size]
+        if not self.isValid(offset, size):
+            return None
+        return data
+
+    def isCurrent(self):
+        """
+        Returns whether path still is this region, and not one created
+        since by another publisher.
+        """
+        try:
+            return os.stat(self.path).st_ino == self.inode
+        except OSError:
+            return False
+
+    def close(self):
+        self._map.close()
+        if self._owner and self.isCurrent():
+            os.unlink(self.path)
+
+
+class SharedStorePublisher(log.Loggable):
+    """
+    I publish the fragments and manifests of a L{FragmentStore} in a
+    L{SharedRegion}. The store calls me when it registers and unregisters
+    fragments and when its manifest changes; the index is written once per
+    reactor iteration.
+    """
+
+    logCategory = 'shared-store'
+
+    def __init__(self, region, store):
+        self._region = region
+        self._store = store
+        self._fragments = {} # path -> (offset, size, kind, etag, date, mime)
+        self._last = {} # 'type:bitrate' -> timestamp of the last fragment
+        self._manifests = {} # encoding -> (offset, size, etag)
+        self._ready = False
+        self._flushCall = None
+
+    def getRegion(self):
+        return self._region
+
+    def registerFragment(self, quality, fragment):
+        offset = self._region.writeData(fragment.getParts(), fragment.size)
+        if offset is None:
+            self.warning("Fragment %d of %d bytes doesn't fit in %s",
+                         fragment.timestamp, fragment.size,
+                         self._region.path)
+            return
+        mime = quality.getStream().getMime()
+        for path, kind in quality.getFragmentPaths(fragment.timestamp):
+            size = fragment.size
+            if kind == "info":
+                size = fragment.infoSize
+            self._fragments[path] = (offset, size, kind,
+                                     fragment.getETag(kind),
+                                     fragment.published, mime)
+        key = '%s:%d' % (quality.getStream().Type, quality.Bitrate)
+        self._last[key] = max(self._last.get(key, fragment.timestamp),
+                              fragment.timestamp)
+        self.invalidate()
+
+    def unregisterFragment(self, quality, fragment):
+        for path, kind in quality.getFragmentPaths(fragment.timestamp):
+            self._fragments.pop(path, None)
+        self.invalidate()
+
+    def invalidate(self):
+        if self._flushCall is None:
+            self._flushCall = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        """
+        Write the manifests that changed and publish the index.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        region = self._region
+        encodings = self._store.getManifestEncodings()
+        for e in [None] + list(encodings):
+            body, etag = self._store.getManifest(e)
+            key = e or ''
+            old = self._manifests.get(key)
+            # rewrite it before the ring wraps over it
+            if old and old[2] == etag and region.getWritten() - old[0] < \
+                    region.dataSize / 2:
+                continue
+            offset = region.writeData([body], len(body))
+            if offset is None:
+                self.warning("Manifest doesn't fit in %s", region.path)
+                continue
+            self._manifests[key] = (offset, len(body), etag)
+        # forget the fragments the ring wrapped over
+        for path, entry in self._fragments.items():
+            if not region.isValid(entry[0], entry[1]):
+                del self._fragments[path]
+        self._ready = self._ready or self._store.prerolled()
+        index = {'fragments': self._fragments,
+                 'manifests': self._manifests,
+                 'encodings': list(encodings),
+                 'max-age': self._store.getManifestMaxAge(),
+                 'last': self._last,
+                 'ready': self._ready}
+        try:
+            region.writeIndex(marshal.dumps(index))
+        except ValueError, e:
+            self.warning("Could not publish the index: %s", e)
+
+    def close(self):
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        self._region.close()
+
+
+class SharedFragment(object):
+    """
+    A copy of a fragment, or fragment info, read from a L{SharedRegion}.
+    It has the interface of a stored fragment used to serve it.
+    """
+
+    def __init__(self, data, etag, published):
+        self.data = data
+        self.etag = etag
+        self.published = published
+
+    def getParts(self, kind=None):
+        return [self.data]
+
+    def getETag(self, kind=None):
+        return self.etag
+
+
+class SharedStoreReader(log.Loggable):
+    """
+    I serve the fragments and manifests published in a L{SharedRegion} by
+    a L{SharedStorePublisher}, with the interface of a L{FragmentStore}
+    used by the resources. I attach to the region once it exists, and to
+    the new one when the publisher is restarted.
+    """
+
+    logCategory = 'shared-store'
+
+    def __init__(self, path):
+        self._path = path
+        self._region = None
+        self._checked = 0
+        self._seq = None
+        self._index = self._emptyIndex()
+
+    def _emptyIndex(self):
+        return {'fragments': {}, 'manifests': {}, 'encodings': [],
+                'max-age': 1, 'last': {}, 'ready': False}
+
+    def _attach(self):
+        now = time.time()
+        if now - self._checked < REATTACH_INTERVAL:
+            return
+        self._checked = now
+        if self._region and self._region.isCurrent():
+            return
+        try:
+            region = SharedRegion(self._path)
+        except (OSError, ValueError, mmap.error), e:
+            self.debug("Could not attach to %s: %s", self._path, e)
+            return
+        self.info("Attached to %s", self._path)
+        if self._region:
+            self._region.close()
+        self._region = region
+        self._seq = None
+        # the offsets of the previous region are meaningless in this one
+        self._index = self._emptyIndex()
+
+    def _refresh(self):
+        self._attach()
+        if not self._region:
+            return
+        seq = self._region.getSeq()
+        if seq == self._seq or seq == 0:
+            # not changed, or nothing published yet
+            return
+        r = self._region.readIndex()
+        if r is None:
+            self.debug("Index kept changing, using the previous one")
+            return
+        self._seq, data = r
+        self._index = marshal.loads(data)
+
+    def isReady(self):
+        self._refresh()
+        return self._index['ready']
+
+    def getManifestEncodings(self):
+        self._refresh()
+        return self._index['encodings']
+
+    def getManifestMaxAge(self):
+        self._refresh()
+        return self._index['max-age']
+
+    def getManifest(self, encoding=None):
+        for i in xrange(2):
+            self._refresh()
+            offset, size, etag = self._index['manifests'][encoding or '']
+            data = self._region.readData(offset, size)
+            if data is not None:
+                return data, etag
+            # the publisher rewrote it, use the new index
+            self._seq = None
+        raise KeyError(encoding)
+
+    def lookup(self, path):
+        """
+        @returns: (fragment, kind, mime) or None
+        """
+        self._refresh()
+        entry = self._index['fragments'].get(path)
+        if entry is None:
+            return None
+        offset, size, kind, etag, published, mime = entry
+        data = self._region.readData(offset, size)
+        if data is None:
+            return None
+        return SharedFragment(data, etag, published), kind, mime
+
+    def getFragment(self, bitrate, type, timestamp, kind=None):
+        """
+        Like L{FragmentStore.getFragment}. The fragments after the last
+        published fragment might be in the lookahead of the publisher.
+        """
+        name = "Fragments"
+        if kind == "info":
+            name = "FragmentInfo"
+        published = self.lookup("QualityLevels(%s)/%s(%s=%d)"
+                                % (bitrate, name, type, timestamp))
+        if published:
+            fragment, kind, mime = published
+            return (fragment, mime, 200)
+        last = self._index['last'].get('%s:%s' % (type, bitrate))
+        if last is not None and timestamp > last:
+            return (None, None, 412)
+        raise FragmentNotFound(timestamp)
+
+    def waitFragment(self, bitrate, type, timestamp, timeout):
+        """
+        Wait for a fragment for which L{getFragment} returned 412. The
+        index is polled, the publisher can't wake us up.
+
+        @returns: a deferred fired once the fragment is published, or after
+                  timeout seconds
+        """
+        d = defer.Deferred()
+        deadline = time.time() + timeout
+
+        def poll():
+            try:
+                code = self.getFragment(bitrate, type, timestamp)[2]
+            except FragmentNotFound:
+                code = None
+            if code != 412 or time.time() >= deadline:
+                d.callback(None)
+            else:
+                reactor.callLater(WAIT_POLL_INTERVAL, poll)
+        reactor.callLater(WAIT_POLL_INTERVAL, poll)
+        return d
+
+    def close(self):
+        if self._region:
+            self._region.close()
+            self._region = None
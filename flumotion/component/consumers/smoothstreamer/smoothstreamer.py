@@ -16,14 +16,20 @@
 # Headers in this file shall remain intact.
 
 import base64
+import bisect
+import hashlib
+import os
 import pprint
 import string
+import time
+import zlib
+from collections import deque
 from cStringIO import StringIO
 
 import gst
 from mp4seek import atoms, iso
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, task
 from flumotion.common.i18n import N_, gettexter
 from flumotion.common import messages
 from flumotion.component.component import moods
@@ -35,15 +41,41 @@ from flumotion.component.common.streamer.fragmentedresource import\
 from flumotion.component.common.streamer.fragmentedstreamer import\
     FragmentedStreamer
 from flumotion.component.consumers.smoothstreamer.resources import\
-    SmoothStreamingResource
+    SmoothStreamingResource, DEFAULT_MAX_OUTSTANDING_BYTES, \
+    DEFAULT_STALL_TIMEOUT
 from flumotion.component.consumers.smoothstreamer import\
-    avcc, waveformatex
+    avcc, boxes, buffers, disktier, handoff, ingest, shmstore, timing,\
+    waveformatex, worker
 
 __all__ = ['SmoothHTTPLiveStreamer']
 __version__ = ""
 T_ = gettexter()
 
 DEFAULT_DVR_WINDOW = 20
+DEFAULT_MANIFEST_ENCODINGS = 'gzip'
+DEFAULT_INGEST_WORKERS = 0
+DEFAULT_INGEST_WORKER_TYPE = ingest.POOL_THREAD
+DEFAULT_RAM_WINDOW = 60
+DEFAULT_FRAGMENT_MAX_AGE = 3600
+DEFAULT_SHARED_STORE_SIZE = shmstore.DEFAULT_DATA_SIZE
+READY_CHECK_INTERVAL = 1.0
+DEFAULT_EDGE_WAIT_TIMEOUT = 5.0
+DEFAULT_UPSTREAM_POLL_INTERVAL = 1.0
+MANIFEST_ENCODINGS = ('gzip', 'deflate')
+
+
+def compress(data, encoding):
+    """
+    Compress data with the given HTTP content-coding.
+
+    @param encoding: one of L{MANIFEST_ENCODINGS}
+    """
+    if encoding == 'gzip':
+        # wbits > 15 makes zlib write a gzip header and trailer
+        c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        c = zlib.compressobj(6)
+    return c.compress(data) + c.flush()
 
 
 class SmoothHTTPLiveStreamer(FragmentedStreamer):
@@ -54,6 +86,24 @@ class SmoothHTTPLiveStreamer(FragmentedStreamer):
     def init(self):
         self.store = FragmentStore()
         self.debug("Smooth HTTP live streamer initializing")
+        for i in ('store-bytes', 'store-max-bytes', 'store-disk-bytes'):
+            self.uiState.addKey(i, 0)
+        self.uiState.addDictKey('store-stream-bytes', {})
+        # buffers pulled by the appsinks wait here for the reactor
+        self._handoff = handoff.HandoffQueue(self._process_buffer)
+        self.uiState.addDictKey('handoff-queue', {})
+        self.uiState.addKey('http-workers', 0)
+        self.uiState.addDictKey('fragment-writes', {})
+        self.uiState.addDictKey('ingest-timings', {})
+        for stage in timing.STAGES:
+            self.uiState.addKey('ingest-%s-p95' % stage, 0.0)
+        self.uiState.addDictKey('ingest-latency', {})
+        self.uiState.addKey('ingest-latency-p95', 0.0)
+        self._workers = None
+        self._sharedStorePath = None
+        self._attached = False # serving the store of another streamer
+        self._edge = False # filling the store from an upstream origin
+        self._readyCheck = None
 
     def getUrl(self):
         slash = ""
@@ -69,6 +119,30 @@ class SmoothHTTPLiveStreamer(FragmentedStreamer):
         return 'text/xml'
 
     def configure_auth_and_resource(self):
+        props = self.config['properties']
+        mode = props.get('shared-store-mode', shmstore.MODE_PUBLISH)
+        if mode not in shmstore.MODES:
+            self.warning("Unknown shared store mode %r, using %r",
+                         mode, shmstore.MODE_PUBLISH)
+        elif mode == shmstore.MODE_ATTACH:
+            if 'shared-store' in props:
+                self._sharedStorePath = \
+                    shmstore.region_path(props['shared-store'])
+                self.store = shmstore.SharedStoreReader(
+                    self._sharedStorePath)
+                self._attached = True
+            else:
+                m = messages.Warning(T_(N_(
+                    "The shared-store to attach to is not set, "
+                    "the fragments will be ingested.")))
+                self.addMessage(m)
+        if not self._attached and 'upstream-url' in props:
+            # imported here, it needs a recent twisted.web.client
+            from flumotion.component.consumers.smoothstreamer import edge
+            self.store = edge.EdgeStore(edge.HTTPFetcher(
+                props['upstream-url'],
+                props.get('upstream-connections', edge.DEFAULT_CONNECTIONS)))
+            self._edge = True
         self.httpauth = http.HTTPAuthentication(self)
         self.resource = SmoothStreamingResource(self, self.store,
                 self.httpauth, self.secret_key, self.session_timeout)
@@ -76,8 +150,141 @@ class SmoothHTTPLiveStreamer(FragmentedStreamer):
     def configure_pipeline(self, pipeline, props):
         FragmentedStreamer.configure_pipeline(self, pipeline, props)
         self.resource.setMountPoint(self.mountPoint)
+        # edges wait for the fragments they fetch on demand
+        waitTimeout = 0
+        if self._edge:
+            waitTimeout = DEFAULT_EDGE_WAIT_TIMEOUT
+        self.resource.setFragmentWaitTimeout(
+            props.get('fragment-wait-timeout', waitTimeout))
+        self.resource.setFragmentMaxAge(
+            props.get('fragment-max-age', DEFAULT_FRAGMENT_MAX_AGE))
+        self.resource.setWriteLimits(
+            props.get('max-outstanding-bytes', DEFAULT_MAX_OUTSTANDING_BYTES),
+            props.get('stall-timeout', DEFAULT_STALL_TIMEOUT))
+        if not self._attached:
+            self._configureStore(props)
+        if self._edge:
+            self.store.start(props.get('upstream-poll-interval',
+                                       DEFAULT_UPSTREAM_POLL_INTERVAL))
+        if self._attached or self._edge:
+            # nothing is ingested, wait for the store to be prerolled
+            self._readyCheck = task.LoopingCall(self._checkReady)
+            self._readyCheck.start(READY_CHECK_INTERVAL)
+        if props.get('http-workers', 0) > 0:
+            self._startWorkers(props)
+
+    def _configureStore(self, props):
         self.store.setDVRWindowLength(props.get('dvr-window',
                                                 DEFAULT_DVR_WINDOW))
+        encodings = []
+        for e in props.get('manifest-encodings',
+                           DEFAULT_MANIFEST_ENCODINGS).split(','):
+            e = e.strip().lower()
+            if not e:
+                continue
+            if e not in MANIFEST_ENCODINGS:
+                self.warning("Ignoring unsupported manifest encoding %r", e)
+                continue
+            encodings.append(e)
+        self.store.setManifestEncodings(encodings)
+        workerType = props.get('ingest-worker-type',
+                               DEFAULT_INGEST_WORKER_TYPE)
+        if workerType not in ingest.POOL_TYPES:
+            self.warning("Unknown ingest worker type %r, using %r",
+                         workerType, DEFAULT_INGEST_WORKER_TYPE)
+            workerType = DEFAULT_INGEST_WORKER_TYPE
+        pool = ingest.createPool(workerType,
+            props.get('ingest-workers', DEFAULT_INGEST_WORKERS))
+        pool.start()
+        self.store.setIngestPool(pool)
+        self.store.setZeroCopy(props.get('zero-copy-fragments', False))
+        self.store.setMaxBytes(props.get('max-store-bytes', 0))
+        if 'disk-tier-directory' in props:
+            self.store.setDiskTier(props['disk-tier-directory'],
+                                   props.get('ram-window', DEFAULT_RAM_WINDOW))
+        if 'shared-store' in props:
+            self._publish(shmstore.region_path(props['shared-store']), props)
+
+    def _publish(self, path, props):
+        region = shmstore.SharedRegion(path, create=True,
+            dataSize=props.get('shared-store-size',
+                               DEFAULT_SHARED_STORE_SIZE))
+        self.store.setPublisher(shmstore.SharedStorePublisher(region,
+                                                              self.store))
+        self._sharedStorePath = path
+
+    def _checkReady(self):
+        if not self._ready and self.store.isReady():
+            self.info("Store prerolled. Changing mood to 'happy'")
+            self.setMood(moods.happy)
+            self._ready = True
+
+    def _startWorkers(self, props):
+        if 'bouncer' in props or 'secret-key' in props:
+            m = messages.Warning(T_(N_(
+                "The HTTP workers can't authenticate the requests, "
+                "they won't be started.")))
+            self.addMessage(m)
+            return
+        if 'http-worker-port' not in props:
+            m = messages.Warning(T_(N_(
+                "The HTTP workers need an http-worker-port, "
+                "they won't be started.")))
+            self.addMessage(m)
+            return
+        if self._sharedStorePath is None:
+            self._publish(os.path.join(shmstore.SHM_DIRECTORY,
+                                       'smoothstreamer-%s-%d'
+                                       % (self.name, os.getpid())), props)
+        self._workers = worker.WorkerPool(props['http-workers'],
+            self._sharedStorePath,
+            props['http-worker-port'], self.resource.mountPoint,
+            props.get('fragment-max-age', DEFAULT_FRAGMENT_MAX_AGE),
+            props.get('max-outstanding-bytes', DEFAULT_MAX_OUTSTANDING_BYTES),
+            props.get('stall-timeout', DEFAULT_STALL_TIMEOUT))
+        self._workers.start()
+
+    def do_stop(self):
+        if self._workers:
+            self._workers.stop()
+        if self._readyCheck and self._readyCheck.running:
+            self._readyCheck.stop()
+        if not self._attached:
+            self.store.getIngestPool().stop()
+        self.store.close()
+        return FragmentedStreamer.do_stop(self)
+
+    def updateState(self, set):
+        FragmentedStreamer.updateState(self, set)
+        if self._workers:
+            set('http-workers', self._workers.getCount())
+        for k, v in self.resource.getWriteStats().asDict().items():
+            self.uiState.setitem('fragment-writes', k, v)
+        if self._attached:
+            return
+        set('store-bytes', self.store.getBytes())
+        set('store-max-bytes', self.store.getMaxBytes())
+        set('store-disk-bytes', self.store.getDiskBytes())
+        streamBytes = self.uiState.get('store-stream-bytes')
+        for type, stream in self.store.getStreams():
+            b = stream.getBytes()
+            if streamBytes.get(type) != b:
+                self.uiState.setitem('store-stream-bytes', type, b)
+        for k, v in self._handoff.getStats().items():
+            self.uiState.setitem('handoff-queue', k, v)
+        timings = self.store.getTimings()
+        published = self.uiState.get('ingest-timings')
+        for k, v in timings.getStats().items():
+            if published.get(k) != v:
+                self.uiState.setitem('ingest-timings', k, v)
+        for stage, v in timings.getWorst().items():
+            set('ingest-%s-p95' % stage, v)
+        latencies = self.store.getLatencies()
+        published = self.uiState.get('ingest-latency')
+        for k, v in latencies.getStats(timing.AVAILABLE).items():
+            if published.get(k) != v:
+                self.uiState.setitem('ingest-latency', k, v)
+        set('ingest-latency-p95', latencies.getWorst()[timing.AVAILABLE])
 
     def get_pipeline_string(self, properties):
         # Similar to the MultiInpuParseLaunch component but whithout the need
@@ -93,12 +300,19 @@ class SmoothHTTPLiveStreamer(FragmentedStreamer):
                 feeds.append(feed)
             eaters = {'default': [(x, 'default') for x in feeds]}
 
+        # when attached to a shared store or pulling from an upstream
+        # origin the buffers are not used, only the last one is kept
+        drop = ''
+        if properties.get('shared-store-mode') == shmstore.MODE_ATTACH and \
+                'shared-store' in properties or 'upstream-url' in properties:
+            drop = 'drop=true max-buffers=1 '
+
         pipeline = ''
         for e in eaters:
             for feed, alias in eaters[e]:
                 pipeline += ' @ eater:%s @ ! appsink '\
-                            'name=sink_%s emit-signals=true sync=false '\
-                            % (alias, alias)
+                            'name=sink_%s emit-signals=true sync=false %s'\
+                            % (alias, alias, drop)
         return pipeline
 
     def _connect_sink_signals(self):
@@ -109,17 +323,17 @@ class SmoothHTTPLiveStreamer(FragmentedStreamer):
                 sink.get_pad("sink").add_buffer_probe(self._sink_pad_probe,
                                                       None)
                 sink.connect('eos', self._eos)
-                sink.connect("new-buffer", self._new_buffer)
+                if not (self._attached or self._edge):
+                    sink.connect("new-buffer", self._new_buffer)
 
-    def _process_buffer(self, sink, buffer):
+    def _process_buffer(self, sink, buffer, received=None):
         sink_name = sink.get_name()
         currOffset = buffer.offset
         self._lastBufferOffset = currOffset
         self._fragmentsCount = self._fragmentsCount + 1
-        f = StringIO(buffer.data)
-        al = list(atoms.read_atoms(f))
-        ad = atoms.atoms_dict(al)
         if (buffer.flag_is_set(gst.BUFFER_FLAG_IN_CAPS)):
+            f = StringIO(buffer.data)
+            ad = atoms.atoms_dict(list(atoms.read_atoms(f)))
             try:
                 self.store.addMoov(sink_name, ad)
             except Exception, e:
@@ -130,10 +344,10 @@ class SmoothHTTPLiveStreamer(FragmentedStreamer):
                 self.addMessage(m)
                 self.error("First buffer cannot be parsed as a moov: %r" % e)
                 return
-        elif iso.select_atoms(ad, ('moof', 0, 1))[0]:
-            fragName = self.store.addFragment(sink_name, ad, al,
+        else:
+            fragName = self.store.addFragment(sink_name, buffer.data,
                                               buffer.timestamp,
-                                              buffer.duration)
+                                              buffer.duration, received)
             if fragName is None:
                 return
             self.info('Added fragment "%s", duration=%s',
@@ -148,7 +362,7 @@ class SmoothHTTPLiveStreamer(FragmentedStreamer):
     def _new_buffer(self, appsink):
         self.log("appsink created a new fragment")
         buf = appsink.emit('pull-buffer')
-        reactor.callFromThread(self._process_buffer, appsink, buf)
+        self._handoff.push((appsink, buf, time.time()))
 
     ### END OF THREAD-AWARE CODE
 
@@ -167,8 +381,15 @@ class Quality(log.Loggable, AttributesMixin):
             self.warning('Setting miniumum lookahead to 1')
             lookahead = 1
         self._lookahead = lookahead
-        self._lookaheads = [] # list of (atomd, atoml, ts, buffer)
-        self._fragments = {} # ts -> [buffer, info_buffer, duration]
+        self._lookaheads = [] # list of (data, ts, duration, received)
+        self._processing = {} # seq -> ts, fragments in the ingest pool
+        self._received = {} # seq -> time the appsink handed it over
+        self._processed = {} # seq -> Fragment, None if it failed
+        self._submitted = 0
+        self._published = 0
+        self._fragments = FragmentRing()
+        self._resident = deque() # fragments not demoted to disk yet
+        self._waiters = {} # ts -> [(deferred, delayed call)]
         self._track_id = None
         self._stream = None
         self._store = store
@@ -176,97 +397,430 @@ class Quality(log.Loggable, AttributesMixin):
     def setStream(self, stream):
         self._stream = stream
 
+    def getStream(self):
+        return self._stream
+
     def setTrackId(self, track_id):
         self._track_id = track_id
 
     def getTrackId(self):
         return self._track_id
 
+    def getName(self):
+        return "%s-%d" % (self._stream.Type, self.Bitrate)
+
     def getFragments(self):
-        return self._fragments.items()
+        return [(f.timestamp, f) for f in self._fragments]
+
+    def getBytes(self):
+        return self._fragments.size
+
+    def getOldestFragment(self):
+        return self._fragments.first()
+
+    def getLastFragment(self):
+        return self._fragments.last()
+
+    def getFragmentCount(self):
+        return len(self._fragments)
 
-    def addFragment(self, ad, al, timestamp, duration):
+    def addFragment(self, data, timestamp, duration, received=None):
         timestamp = timestamp * self._stream.TimeScale / gst.SECOND
         duration = duration * self._stream.TimeScale / gst.SECOND
-        self._lookaheads.append((ad, al, timestamp, duration))
+        self._lookaheads.append((data, timestamp, duration, received))
         name = "fragment id: %d, b: %d, t: %d, d: %d" % \
             (self._track_id, self.Bitrate, timestamp, duration)
 
         if (len(self._lookaheads) > self._lookahead):
-            ad, al, timestamp, duration = self._lookaheads.pop(0)
-            moof = iso.select_atoms(ad, ('moof', 1, 1))[0]
-            mdat = iso.select_atoms(ad, ('mdat', 1, 1))[0]
+            data, timestamp, duration, received = self._lookaheads.pop(0)
 
             # prepare "next" uuid box
             next = []
             for la in self._lookaheads:
-                next.append((la[2], la[3]))
-            # add live SS "uuid" boxes
-            extra = [iso.uuid_sscurrent.make(timestamp, duration),
-                     iso.uuid_ssnext.make(next)]
-            moof.traf.uuid.extend(extra)
-            # make sure they are also written
-            moof.traf.add_extra_children(extra)
-
-            # get the modified buffer back
-            outf = StringIO()
-            iso.write_atoms([moof, mdat], outf)
-            b = outf.getvalue()
-            outf = StringIO()
-            iso.write_atoms([moof], outf)
-            info = outf.getvalue()
-
-            # it's a duration-limited list..
-            ts = self._fragments.keys()
-            if len(ts) > 0:
-                ts.sort()
-                window = ts[-1] - ts[0]
-                while True:
-                    if (window >= self._store.DVRWindowLength):
-                        if len(self._fragments) == 0:
-                            break
-                        m = min(self._fragments.keys())
-                        self.debug("removing %r" % m)
-                        frag_duration = self._fragments[m][2]
-                        del self._fragments[m]
-                        window -= frag_duration
-                    else:
-                        break
-
-            # & add our buffer to the list of fragments
-            self.debug("added %r buffer" % timestamp)
-            self._fragments[timestamp] = [b, info, duration]
+                next.append((la[1], la[2]))
+
+            # the fragment is rewritten by the ingest pool, possibly out of
+            # order with the others, but published in order
+            seq = self._submitted
+            self._submitted += 1
+            self._processing[seq] = timestamp
+            if received is not None:
+                self._received[seq] = received
+            pool = self._store.getIngestPool()
+            submitted = time.time()
+            if self._store.getZeroCopy():
+                d = pool.submit(ingest.make_live_moof,
+                                data, timestamp, duration, next)
+                d.addCallback(self._moofProcessed, data, timestamp, duration)
+            else:
+                d = pool.submit(ingest.make_live_fragment,
+                                data, timestamp, duration, next)
+                d.addCallback(self._fragmentProcessed, timestamp, duration)
+            d.addCallback(self._timed, 'rewrite', submitted)
+            d.addCallbacks(self._addProcessed, self._fragmentFailed,
+                           callbackArgs=(seq, ), errbackArgs=(seq, timestamp))
         return name
 
-    def getFragment(self, timestamp, kind=None):
-        f = self._fragments.get(timestamp)
-        if not f:
+    def _fragmentProcessed(self, result, timestamp, duration):
+        b, moofSize = result
+        return Fragment(timestamp, duration, [b], moofSize)
+
+    def _moofProcessed(self, result, data, timestamp, duration):
+        # the new moof and the mdat are kept apart, the mdat is not copied
+        moof, offset, size = result
+        return Fragment(timestamp, duration,
+                        [moof, buffer(data, offset, size)], len(moof))
+
+    def _timed(self, result, stage, start):
+        # the time spent in the ingest pool, waiting included
+        self._store.addTiming(self, stage, time.time() - start)
+        return result
+
+    def _addProcessed(self, fragment, seq):
+        self._processed[seq] = fragment
+        self._publishProcessed()
+
+    def _fragmentFailed(self, failure, seq, timestamp):
+        self.warning("Could not process fragment %r: %s", timestamp,
+                     failure.getErrorMessage())
+        self._processed[seq] = None
+        self._publishProcessed()
+
+    def _publishProcessed(self):
+        while self._published in self._processed:
+            processed = self._processed.pop(self._published)
+            timestamp = self._processing.pop(self._published)
+            received = self._received.pop(self._published, None)
+            self._published += 1
+            if processed is not None:
+                self.publishFragment(processed)
+                if received is not None:
+                    self._store.addLatency(self, time.time() - received)
+            else:
+                self._wakeWaiters(timestamp)
+
+    def publishFragment(self, fragment):
+        # it's a duration-limited list..
+        start = time.time()
+        evicted = 0
+        while len(self._fragments) and \
+                self._fragments.window() >= self._store.DVRWindowLength:
+            self.evictOldest()
+            evicted += 1
+        if evicted:
+            self._store.addTiming(self, 'evict', time.time() - start)
+
+        # & add our buffer to the list of fragments
+        self.debug("added %r buffer" % fragment.timestamp)
+        fragment.etag = '"%d-%d-%d"' % (self._track_id, self.Bitrate,
+                                        fragment.timestamp)
+        fragment.published = int(time.time())
+        old = self._fragments.get(fragment.timestamp)
+        if old:
+            self._store.unregisterFragment(self, old)
+            self._store.updateBytes(-old.size)
+            if old.demoted or old.demoting:
+                self._store.updateDiskBytes(-old.size)
+            elif old in self._resident:
+                self._resident.remove(old)
+            old.release()
+        else:
+            self._stream.addChunk(fragment.timestamp, fragment.duration)
+        self._fragments.append(fragment)
+        self._store.registerFragment(self, fragment)
+        self._store.updateBytes(fragment.size)
+        self._store.invalidateManifest()
+        self._store.enforceMaxBytes()
+        self._wakeWaiters(fragment.timestamp)
+
+        segments = self._store.getSegments()
+        if segments:
+            self._resident.append(fragment)
+            # keep only the most recent fragments in memory
+            limit = fragment.timestamp - \
+                self._store.getRAMWindowLength() * self._stream.TimeScale
+            while self._resident and self._resident[0].timestamp < limit:
+                self.demoteOldest()
+
+    def getOldestResident(self):
+        """
+        Returns the oldest fragment kept in memory, unless it is the last
+        one.
+        """
+        if len(self._resident) < 2:
             return None
-
-        if kind == "info":
-            return f[1]
-
-        return f[0]
+        return self._resident[0]
+
+    def demoteOldest(self):
+        self._store.demoteFragment(self._resident.popleft())
+
+    def evictOldest(self):
+        evicted = self._fragments.popleft()
+        self.debug("removing %r" % evicted.timestamp)
+        if self._resident and self._resident[0] is evicted:
+            self._resident.popleft()
+        if evicted.demoted or evicted.demoting:
+            self._store.updateDiskBytes(-evicted.size)
+        evicted.release()
+        self._store.unregisterFragment(self, evicted)
+        self._stream.removeChunk(evicted.timestamp)
+        self._store.updateBytes(-evicted.size)
+        self._store.invalidateManifest()
+        return evicted
+
+    def getFragment(self, timestamp):
+        return self._fragments.get(timestamp)
+
+    def getFragmentPaths(self, timestamp):
+        """
+        Returns the paths, relative to the mount point, of the fragment and
+        fragment info at timestamp.
+
+        @rtype: list of (str, str)
+        """
+        q = "QualityLevels(%d)/" % self.Bitrate
+        t = "(%s=%d)" % (self._stream.Type, timestamp)
+        return [(q + "Fragments" + t, "fragment"),
+                (q + "FragmentInfo" + t, "info")]
+
+    def waitFragment(self, timestamp, timeout):
+        """
+        Wait for a fragment in the lookahead to be published.
+
+        @returns: a deferred fired once the fragment is published, or after
+                  timeout seconds
+        """
+        d = defer.Deferred()
+        waiters = self._waiters.setdefault(timestamp, [])
+
+        def expired():
+            waiters.remove((d, call))
+            if not waiters:
+                del self._waiters[timestamp]
+            d.callback(None)
+        call = reactor.callLater(timeout, expired)
+        waiters.append((d, call))
+        return d
+
+    def _wakeWaiters(self, timestamp):
+        for d, call in self._waiters.pop(timestamp, []):
+            call.cancel()
+            d.callback(None)
 
     def getFragmentInLookAhead(self, timestamp, kind=None):
         for l in self._lookaheads:
-            if l[2] == timestamp:
+            if l[1] == timestamp:
                 return True
-        return False
+        return timestamp in self._processing.values()
 
     def prerolled(self):
-        ts = self._fragments.keys()
-        if len(ts) == 0:
+        if len(self._fragments) == 0:
             return False
-        ts.sort()
-        window = ts[-1] - ts[0]
-        return window >= self._store.DVRWindowLength
+        # a full store won't hold the whole window
+        return self._fragments.window() >= self._store.DVRWindowLength or \
+            self._store.reachedMaxBytes()
+
+
+class Fragment(object):
+    """
+    A published fragment. Its data is kept as a list of parts to be
+    written one after the other, so that they don't need to be joined.
+    The fragment info is the moof, which is the first infoSize bytes of
+    the fragment.
+    """
+
+    def __init__(self, timestamp, duration, parts, infoSize):
+        self.timestamp = timestamp
+        self.duration = duration
+        self.parts = parts
+        self.infoSize = infoSize
+        self.size = buffers.parts_size(parts)
+        self.demoted = False # the parts are on disk
+        self.demoting = False # the parts are being written to disk
+        self.released = False
+        self.etag = None
+        self.published = None
+
+    def getParts(self, kind=None):
+        """
+        @param kind: "info" for the fragment info, the fragment otherwise
+        """
+        if kind == "info":
+            return buffers.prefix(self.parts, self.infoSize)
+        return self.parts
 
+    def getETag(self, kind=None):
+        if kind == "info":
+            return self.etag[:-1] + '-info"'
+        return self.etag
+
+    def demote(self, segments):
+        """
+        Move the data of the fragment to disk.
+
+        @type segments: L{disktier.SegmentStore}
+        """
+        self.setDiskParts(segments.write(self.parts))
+
+    def setDiskParts(self, parts):
+        """
+        Replace the parts by the ones they were written to on disk.
+
+        @type parts: list of L{disktier.DiskPart}
+        """
+        self.parts = parts
+        self.demoting = False
+        self.demoted = True
+
+    def refSegments(self):
+        """
+        Keep the segments of a demoted fragment while it is written to a
+        client, even if it is evicted meanwhile.
+
+        @returns: the segments to unref once written
+        @rtype:   list of L{disktier.Segment}
+        """
+        if not self.demoted:
+            return []
+        segments = [p.segment for p in self.parts]
+        for s in segments:
+            s.ref()
+        return segments
+
+    def release(self):
+        """
+        Called once the fragment is evicted from the store.
+        """
+        self.released = True
+        if not self.demoted:
+            return
+        for p in self.parts:
+            p.segment.unref()
 
-class Chunk(AttributesMixin):
 
-    def __init__(self, t):
-        self.t = t
+class FragmentRing(object):
+    """
+    I keep fragments, or anything else with a timestamp and a duration,
+    ordered by timestamp. They are appended at the tail and evicted from
+    the head in constant time, and looked up by timestamp with a binary
+    search.
+
+    @ivar duration: sum of the durations of the fragments
+    @ivar size:     sum of the sizes of the fragments
+    """
+
+    def __init__(self):
+        # evicted fragments are only removed from the lists once they
+        # take half of them, the live ones start at _head
+        self._timestamps = []
+        self._fragments = []
+        self._head = 0
+        self.duration = 0
+        self.size = 0
+
+    def __len__(self):
+        return len(self._fragments) - self._head
+
+    def __iter__(self):
+        for i in xrange(self._head, len(self._fragments)):
+            yield self._fragments[i]
+
+    def first(self):
+        if not len(self):
+            return None
+        return self._fragments[self._head]
+
+    def last(self):
+        if not len(self):
+            return None
+        return self._fragments[-1]
+
+    def window(self):
+        """
+        Returns the duration from the first to the last fragment.
+        """
+        if not len(self):
+            return 0
+        return self.duration - self._fragments[-1].duration
+
+    def append(self, fragment):
+        t = fragment.timestamp
+        if not len(self) or t > self._timestamps[-1]:
+            self._timestamps.append(t)
+            self._fragments.append(fragment)
+        else:
+            # timestamps went back, keep the list ordered
+            i = self._index(t)
+            if i < len(self._timestamps) and self._timestamps[i] == t:
+                self.duration -= self._fragments[i].duration
+                self.size -= self._fragments[i].size
+                self._fragments[i] = fragment
+            else:
+                self._timestamps.insert(i, t)
+                self._fragments.insert(i, fragment)
+        self.duration += fragment.duration
+        self.size += fragment.size
+
+    def popleft(self):
+        fragment = self._fragments[self._head]
+        self._fragments[self._head] = None
+        self._head += 1
+        self.duration -= fragment.duration
+        self.size -= fragment.size
+        if self._head * 2 > len(self._fragments):
+            del self._timestamps[:self._head]
+            del self._fragments[:self._head]
+            self._head = 0
+        return fragment
+
+    def remove(self, timestamp):
+        """
+        Remove the fragment at timestamp.
+
+        @raises KeyError: if there is no fragment at timestamp
+        """
+        i = self._index(timestamp)
+        if i == len(self._timestamps) or self._timestamps[i] != timestamp:
+            raise KeyError(timestamp)
+        if i == self._head:
+            return self.popleft()
+        del self._timestamps[i]
+        fragment = self._fragments.pop(i)
+        self.duration -= fragment.duration
+        self.size -= fragment.size
+        return fragment
+
+    def get(self, timestamp):
+        i = self._index(timestamp)
+        if i < len(self._timestamps) and self._timestamps[i] == timestamp:
+            return self._fragments[i]
+        return None
+
+    def since(self, timestamp):
+        """
+        Iterate over the fragments starting at timestamp or later.
+        """
+        for i in xrange(self._index(timestamp), len(self._fragments)):
+            yield self._fragments[i]
+
+    def _index(self, timestamp):
+        return bisect.bisect_left(self._timestamps, timestamp, self._head)
+
+
+class Chunk(object):
+    """
+    An entry of the timeline of a stream, shared by the fragments of all
+    its qualities starting at the same time.
+    """
+
+    __slots__ = ('timestamp', 'duration', 'refcount')
+    # the timeline is a FragmentRing, but chunks hold no data
+    size = 0
+
+    def __init__(self, timestamp, duration):
+        self.timestamp = timestamp
+        self.duration = duration
+        self.refcount = 1
 
 
 class Stream(AttributesMixin):
@@ -283,6 +837,7 @@ class Stream(AttributesMixin):
         self.Chunks = chunks
         self.Url = "QualityLevels({bitrate})/Fragments(%s={start time})" % type
         self._qualities = {} # bitrate -> q
+        self._timeline = FragmentRing() # of Chunk
         if mime:
             self._mime = mime
         else:
@@ -296,8 +851,7 @@ class Stream(AttributesMixin):
             q = Quality(store, bitrate)
             q.Index = len(self._qualities)
             self._qualities[bitrate] = q
-        q = self._qualities[bitrate]
-        return q
+        return self._qualities.get(bitrate)
 
     def getQualities(self):
         return self._qualities.items()
@@ -305,18 +859,39 @@ class Stream(AttributesMixin):
     def getMime(self):
         return self._mime
 
-    def getFragments(self):
-        # some magic to show the list of available chunks
-        ts = []
-        # firs, get a list of all ts in all qualities
-        for br, q in self._qualities.items():
-            for t, b in q.getFragments():
-                if t not in ts:
-                    ts.append(t)
-        # then, sort them and remove the ones that are out of the window
-        ts.sort()
-        min_ts = ts[-1] - self._store.DVRWindowLength
-        return [Chunk(t) for t in ts if ts >= min_ts]
+    def getBytes(self):
+        return sum([q.getBytes() for q in self._qualities.values()])
+
+    def addChunk(self, timestamp, duration):
+        c = self._timeline.get(timestamp)
+        if c:
+            c.refcount += 1
+        else:
+            self._timeline.append(Chunk(timestamp, duration))
+
+    def removeChunk(self, timestamp):
+        c = self._timeline.get(timestamp)
+        if not c:
+            return
+        c.refcount -= 1
+        if c.refcount == 0:
+            self._timeline.remove(timestamp)
+
+    def getLastChunk(self):
+        return self._timeline.last()
+
+    def getChunks(self):
+        """
+        Returns the chunks available in any of the qualities, without the
+        ones out of the DVR window.
+
+        @rtype: iterator of L{Chunk}
+        """
+        last = self._timeline.last()
+        if not last:
+            return iter([])
+        return self._timeline.since(last.timestamp -
+                                    self._store.DVRWindowLength)
 
     def getAttributes(self):
         return self.__dict__
@@ -335,10 +910,168 @@ class FragmentStore(log.Loggable):
         self.IsLive = "TRUE"
         self._streams = {} # type (audio,video,text) -> stream
         self._qualities = {} # (sink, track_id) -> quality
+        self._manifestEncodings = []
+        self._manifests = None # encoding -> (manifest, etag)
+        self._ingestPool = ingest.InlinePool()
+        self._zeroCopy = False
+        self._bytes = 0
+        self._maxBytes = 0 # 0 for no limit
+        self._reachedMaxBytes = False
+        self._segments = None
+        self._ramWindowLength = 0 # in seconds
+        self._paths = {} # path -> (fragment, kind, mime)
+        self._diskBytes = 0
+        self._publisher = None
+        self._timings = timing.IngestTimings()
+        self._latencies = timing.IngestTimings([timing.AVAILABLE])
 
     def setDVRWindowLength(self, window_in_sec):
         self._dvr_window_length_sec = window_in_sec
 
+    def setManifestEncodings(self, encodings):
+        """
+        @param encodings: content-codings the manifest is compressed with,
+                          in order of preference
+        @type  encodings: list of str
+        """
+        self._manifestEncodings = list(encodings)
+        self.invalidateManifest()
+
+    def getManifestEncodings(self):
+        return self._manifestEncodings
+
+    def setIngestPool(self, pool):
+        self._ingestPool = pool
+
+    def getIngestPool(self):
+        return self._ingestPool
+
+    def setMaxBytes(self, maxBytes):
+        """
+        @param maxBytes: size the fragments of all the streams can take
+                         together, or 0 for no limit
+        """
+        self._maxBytes = maxBytes
+
+    def getMaxBytes(self):
+        return self._maxBytes
+
+    def getBytes(self):
+        return self._bytes
+
+    def getStreams(self):
+        return self._streams.items()
+
+    def updateBytes(self, delta):
+        self._bytes += delta
+
+    def setDiskTier(self, directory, ramWindowLength):
+        """
+        Move the fragments older than ramWindowLength seconds to segment
+        files in directory.
+        """
+        self._segments = disktier.SegmentStore(directory)
+        self._ramWindowLength = ramWindowLength
+
+    def getSegments(self):
+        return self._segments
+
+    def getRAMWindowLength(self):
+        return self._ramWindowLength
+
+    def getDiskBytes(self):
+        return self._diskBytes
+
+    def getRAMBytes(self):
+        return self._bytes - self._diskBytes
+
+    def demoteFragment(self, fragment):
+        """
+        Move the data of a fragment to the disk tier. It is written by a
+        thread and served from memory until then, but already counted as
+        on disk.
+        """
+        fragment.demoting = True
+        self.updateDiskBytes(fragment.size)
+        d = self._segments.writeInThread(fragment.parts)
+        d.addCallbacks(self._fragmentDemoted, self._demotionFailed,
+                       callbackArgs=(fragment, ), errbackArgs=(fragment, ))
+
+    def _fragmentDemoted(self, parts, fragment):
+        if fragment.released:
+            for p in parts:
+                p.segment.unref()
+            return
+        fragment.setDiskParts(parts)
+
+    def _demotionFailed(self, failure, fragment):
+        self.warning("Could not move fragment %r to disk: %s",
+                     fragment.timestamp, failure.getErrorMessage())
+        fragment.demoting = False
+        if not fragment.released:
+            self.updateDiskBytes(-fragment.size)
+
+    def updateDiskBytes(self, delta):
+        self._diskBytes += delta
+
+    def setPublisher(self, publisher):
+        """
+        Also publish the fragments and manifests of the store in shared
+        memory.
+
+        @type publisher: L{shmstore.SharedStorePublisher}
+        """
+        self._publisher = publisher
+        publisher.invalidate()
+
+    def getPublisher(self):
+        return self._publisher
+
+    def close(self):
+        if self._segments:
+            self._segments.close()
+        if self._publisher:
+            self._publisher.close()
+
+    def reachedMaxBytes(self):
+        return self._reachedMaxBytes
+
+    def enforceMaxBytes(self):
+        """
+        Make the fragments kept in memory fit in the size limit of the
+        store. The oldest ones of all the qualities are moved to the disk
+        tier if there is one, or evicted otherwise. The last fragment of a
+        quality is always kept in memory.
+        """
+        while self._maxBytes and self.getRAMBytes() > self._maxBytes:
+            oldest, oldestTime = None, None
+            for q in self._qualities.values():
+                if self._segments:
+                    f = q.getOldestResident()
+                elif q.getFragmentCount() < 2:
+                    f = None
+                else:
+                    f = q.getOldestFragment()
+                if f is None:
+                    continue
+                # the streams might use different timescales
+                t = float(f.timestamp) / q.getStream().TimeScale
+                if oldest is None or t < oldestTime:
+                    oldest, oldestTime = q, t
+            if oldest is None:
+                break
+            if self._segments:
+                oldest.demoteOldest()
+            else:
+                self._reachedMaxBytes = True
+                oldest.evictOldest()
+
+    def setZeroCopy(self, zeroCopy):
+        self._zeroCopy = zeroCopy
+
+    def getZeroCopy(self):
+        return self._zeroCopy
+
     def addMoov(self, sink, moovd):
         moov = iso.select_atoms(moovd, ('moov', 1, 1))[0]
         pprint.pprint(moov)
@@ -353,6 +1086,7 @@ class FragmentStore(log.Loggable):
                 self._addH264Track(sink, t)
             if type == "mp4a":
                 self._addAACTrack(sink, t)
+        self.invalidateManifest()
 
     def getFragment(self, bitrate, type, time, kind=None):
         stream = self._streams.get(type)
@@ -362,9 +1096,9 @@ class FragmentStore(log.Loggable):
 
         quality = stream.getQuality(self, bitrate, False)
         if not quality:
-            self.warning("bad bitrate %d" % bitrate)
+            self.warning("bad bitrate %s" % bitrate)
             raise FragmentNotFound(time)
-        f = quality.getFragment(time, kind)
+        f = quality.getFragment(time)
         if f:
             return (f, stream.getMime(), 200)
         elif quality.getFragmentInLookAhead(time, kind):
@@ -372,16 +1106,71 @@ class FragmentStore(log.Loggable):
         else:
             raise FragmentNotFound(time)
 
-    def addFragment(self, sink, ad, al, timestamp, duration):
+    def lookup(self, path):
+        """
+        Returns the published fragment at path, relative to the mount point,
+        as registered by L{registerFragment}.
+
+        @returns: (fragment, kind, mime) or None
+        """
+        return self._paths.get(path)
+
+    def registerFragment(self, quality, fragment):
+        mime = quality.getStream().getMime()
+        for path, kind in quality.getFragmentPaths(fragment.timestamp):
+            self._paths[path] = (fragment, kind, mime)
+        if self._publisher:
+            self._publisher.registerFragment(quality, fragment)
+
+    def unregisterFragment(self, quality, fragment):
+        for path, kind in quality.getFragmentPaths(fragment.timestamp):
+            self._paths.pop(path, None)
+        if self._publisher:
+            self._publisher.unregisterFragment(quality, fragment)
+
+    def waitFragment(self, bitrate, type, time, timeout):
+        """
+        Wait for a fragment for which L{getFragment} returned 412.
+
+        @returns: a deferred fired once the fragment is published, or after
+                  timeout seconds
+        """
+        quality = self._streams[type].getQuality(self, bitrate, False)
+        return quality.waitFragment(time, timeout)
+
+    def getTimings(self):
+        return self._timings
+
+    def addTiming(self, quality, stage, seconds):
+        self._timings.add(quality.getName(), stage, seconds)
+
+    def getLatencies(self):
+        return self._latencies
+
+    def addLatency(self, quality, seconds):
+        self._latencies.add(quality.getName(), timing.AVAILABLE, seconds)
+
+    def addFragment(self, sink, data, timestamp, duration, received=None):
         # add fragment in correct track id
-        moof = iso.select_atoms(ad, ('moof', 1, 1))[0]
-        track_id = moof.traf.tfhd.track_id
+        start = time.time()
+        try:
+            track_id = boxes.get_track_id(data)
+        except ValueError, e:
+            self.warning("Could not parse fragment: %s", e)
+            return None
+        if track_id is None:
+            self.debug("Ignoring buffer without moof")
+            return None
         if (sink, track_id) not in self._qualities:
             self.warning("Trying to add a fragment with an unknown "
                          "track_id=%s" % track_id)
             return None
         q = self._qualities[(sink, track_id)]
-        return q.addFragment(ad, al, timestamp, duration)
+        if received is not None:
+            # time spent waiting for the reactor in the handoff queue
+            self.addTiming(q, 'queue', start - received)
+        self.addTiming(q, 'parse', time.time() - start)
+        return q.addFragment(data, timestamp, duration, received)
 
     def getStream(self, type, timescale, subtype=None, mime=None):
         # Fixme what if we have several stream of the same
@@ -454,17 +1243,58 @@ class FragmentStore(log.Loggable):
             l.sort()
             return string.join(l, " ")
 
-        m = """<?xml version="1.0"?>\n"""
-        m += '<SmoothStreamingMedia MajorVersion="2" ' \
-             'MinorVersion="0" %s>\n' % make_attributes(self.__dict__)
+        m = ["""<?xml version="1.0"?>\n"""]
+        m.append('<SmoothStreamingMedia MajorVersion="2" '
+                 'MinorVersion="0" %s>\n' % make_attributes(self.__dict__))
         for s in self._streams.values():
-            m += """  <StreamIndex %s>\n""" % \
-                make_attributes(s.getAttributes())
+            m.append("""  <StreamIndex %s>\n""" %
+                     make_attributes(s.getAttributes()))
             for id, q in s.getQualities():
-                m += """    <QualityLevel %s />\n""" % \
-                        make_attributes(q.getAttributes())
-            for c in s.getFragments():
-                m += """    <c %s />\n""" % make_attributes(c.getAttributes())
-            m += """  </StreamIndex>\n"""
-        m += """</SmoothStreamingMedia>\n"""
-        return m
+                m.append("""    <QualityLevel %s />\n""" %
+                         make_attributes(q.getAttributes()))
+            for c in s.getChunks():
+                m.append("""    <c t="%d" />\n""" % c.timestamp)
+            m.append("""  </StreamIndex>\n""")
+        m.append("""</SmoothStreamingMedia>\n""")
+        return "".join(m)
+
+    def getManifestMaxAge(self):
+        """
+        Returns how long caches can keep the manifest, half the duration of
+        the last fragments, in seconds.
+        """
+        durations = [0]
+        for stream in self._streams.values():
+            c = stream.getLastChunk()
+            if c:
+                durations.append(c.duration / 2 / stream.TimeScale)
+        return max(1, max(durations))
+
+    def invalidateManifest(self):
+        """
+        Drop the cached manifests, they will be rendered again on the next
+        call to L{getManifest}.
+        """
+        self._manifests = None
+        if self._publisher:
+            self._publisher.invalidate()
+
+    def getManifest(self, encoding=None):
+        """
+        Returns the manifest and its entity tag. The manifest, and its
+        compressed variants, are only rendered once per change of the store.
+
+        @param encoding: one of the encodings set with
+                         L{setManifestEncodings}, or None for the
+                         uncompressed manifest
+        @rtype: tuple of (str, str)
+        """
+        if self._manifests is None:
+            manifest = self.renderManifest()
+            digest = hashlib.md5(manifest).hexdigest()
+            manifests = {None: (manifest, '"%s"' % digest)}
+            for e in self._manifestEncodings:
+                manifests[e] = (compress(manifest, e),
+                                '"%s-%s"' % (digest, e))
+            self._manifests = manifests
+        return self._manifests[encoding]
@@ -0,0 +1,108 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from collections import deque
+
+__version__ = "$Rev$"
+
+# the stages a fragment goes through, in order: waiting for the reactor
+# in the handoff queue, parsing its track id, rewriting its boxes in the
+# ingest pool and evicting older fragments out of the DVR window
+STAGES = ('queue', 'parse', 'rewrite', 'evict')
+# from the appsink handing a fragment over to it being fetchable, the
+# lookahead hold included
+AVAILABLE = 'available'
+STATS = ('p50', 'p95', 'max')
+DEFAULT_SAMPLES = 256
+
+
+class Histogram(object):
+    """
+    I keep the last durations of an operation and give their percentiles.
+    """
+
+    def __init__(self, samples=DEFAULT_SAMPLES):
+        self._samples = deque(maxlen=samples)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+
+    def getStats(self):
+        """
+        Returns the median, 95th percentile and maximum of the kept
+        durations, in milliseconds.
+
+        @rtype: dict of str -> float
+        """
+        samples = sorted(self._samples)
+        if not samples:
+            return dict([(s, 0.0) for s in STATS])
+        n = len(samples)
+        return {'p50': samples[n / 2] * 1000,
+                'p95': samples[min(n - 1, n * 95 / 100)] * 1000,
+                'max': samples[-1] * 1000}
+
+
+class IngestTimings(object):
+    """
+    I keep a histogram of the time spent on every ingest stage by each
+    quality.
+    """
+
+    def __init__(self, stages=STAGES, samples=DEFAULT_SAMPLES):
+        self._stages = stages
+        self._samples = samples
+        self._histograms = {} # (quality name, stage) -> Histogram
+
+    def add(self, quality, stage, seconds):
+        key = (quality, stage)
+        if key not in self._histograms:
+            self._histograms[key] = Histogram(self._samples)
+        self._histograms[key].add(seconds)
+
+    def getStats(self, stage=None):
+        """
+        Returns the statistics of every quality and stage, keyed by
+        'quality/stage/stat', or by 'quality/stat' for a single stage.
+
+        @rtype: dict of str -> float
+        """
+        stats = {}
+        for (quality, s), h in self._histograms.items():
+            if stage is not None and s != stage:
+                continue
+            for k, v in h.getStats().items():
+                if stage is None:
+                    stats['%s/%s/%s' % (quality, s, k)] = v
+                else:
+                    stats['%s/%s' % (quality, k)] = v
+        return stats
+
+    def getWorst(self, stat='p95'):
+        """
+        Returns the highest value of stat among the qualities, for every
+        stage.
+
+        @rtype: dict of str -> float
+        """
+        worst = dict([(s, 0.0) for s in self._stages])
+        for (quality, stage), h in self._histograms.items():
+            worst[stage] = max(worst[stage], h.getStats()[stat])
+        return worst
@@ -0,0 +1,254 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+HTTP worker process serving the fragments and manifest that a smooth
+streamer publishes in a shared-memory region. Several workers listen on
+the same port with SO_REUSEPORT and the kernel spreads the connections
+between them.
+"""
+
+import optparse
+import os
+import socket
+import sys
+
+from twisted.internet import protocol, reactor, tcp, task
+from twisted.web import resource, server
+try:
+    from twisted.web import http
+except ImportError:
+    from twisted.protocols import http
+
+from flumotion.common import log
+from flumotion.component.consumers.smoothstreamer import resources, shmstore
+
+__version__ = "$Rev$"
+
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+PARENT_CHECK_INTERVAL = 1.0
+RESPAWN_DELAY = 1.0
+
+# the streamer code comes from bundles, so the workers need the package
+# paths of the streamer to import it
+BOOTSTRAP = """import sys
+paths = %r
+for name in sorted(paths, key=len):
+    __import__(name)
+    sys.modules[name].__path__[:] = paths[name]
+from flumotion.component.consumers.smoothstreamer import worker
+worker.main(sys.argv)
+"""
+
+
+class ReusePort(tcp.Port):
+    """
+    A listening port shared with the other workers.
+    """
+
+    def createInternetSocket(self):
+        s = tcp.Port.createInternetSocket(self)
+        s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return s
+
+
+class WorkerResource(resource.Resource, log.Loggable,
+                     resources.FragmentWriterMixin):
+    """
+    I serve the manifest and the published fragments of a
+    L{shmstore.SharedStoreReader}. Fragments that are not published yet
+    are answered with a 412 straight away.
+    """
+
+    logCategory = 'smooth-worker'
+    isLeaf = True
+
+    def __init__(self, store, mountPoint, fragmentMaxAge,
+                 maxOutstandingBytes=resources.DEFAULT_MAX_OUTSTANDING_BYTES,
+                 stallTimeout=resources.DEFAULT_STALL_TIMEOUT):
+        resource.Resource.__init__(self)
+        self.store = store
+        if not mountPoint.endswith('/'):
+            mountPoint += '/'
+        self.mountPoint = mountPoint
+        self.bytesSent = 0
+        self._fragmentMaxAge = fragmentMaxAge
+        self._writeStats = resources.WriteStats()
+        self._maxOutstandingBytes = maxOutstandingBytes
+        self._stallTimeout = stallTimeout
+
+    def _error(self, request, code):
+        request.setResponseCode(code)
+        request.setHeader('content-type', 'text/html')
+        request.setHeader('content-length', 0)
+        request.finish()
+        return server.NOT_DONE_YET
+
+    def _render(self, request):
+        if not request.path.startswith(self.mountPoint):
+            return self._error(request, http.FORBIDDEN)
+        if not self.store.isReady():
+            return self._error(request, http.SERVICE_UNAVAILABLE)
+        res = request.path[len(self.mountPoint):]
+
+        if res == resources.MANIFEST_NAME:
+            request.setHeader('content-type', resources.XML_CONTENT_TYPE)
+            self._writeManifestBody(request)
+        elif res.endswith(resources.CLIENT_ACCESS_POLICY_NAME):
+            request.setHeader('content-type', resources.XML_CONTENT_TYPE)
+            request.setHeader('content-length',
+                              len(resources.CLIENT_ACCESS_POLICY))
+            if request.method == 'GET':
+                request.write(resources.CLIENT_ACCESS_POLICY)
+        else:
+            published = self.store.lookup(res)
+            if published is None:
+                try:
+                    bitrate, type, time, kind = \
+                        resources.parseFragmentPath(res)
+                    code = self.store.getFragment(bitrate, type, time)[2]
+                except Exception:
+                    code = http.NOT_FOUND
+                return self._error(request, code)
+            fragment, kind, mime = published
+            request.setHeader('content-type', mime)
+            d = self._writeFragmentBody(request, fragment, kind)
+            d.addCallbacks(lambda _: request.finish(),
+                           lambda f: self.debug('fragment not written: %s',
+                                                f.getErrorMessage()))
+            return server.NOT_DONE_YET
+        request.finish()
+        return server.NOT_DONE_YET
+
+    render_GET = _render
+    render_HEAD = _render
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def outReceived(self, data):
+        self._pool.log('worker %d: %s', self.transport.pid, data.rstrip())
+
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self._pool.workerEnded(self, reason)
+
+
+class WorkerPool(log.Loggable):
+    """
+    I spawn and watch the HTTP worker processes of a streamer, respawning
+    the ones that die.
+    """
+
+    logCategory = 'smooth-worker'
+
+    def __init__(self, count, region, port, mountPoint, fragmentMaxAge,
+                 maxOutstandingBytes=resources.DEFAULT_MAX_OUTSTANDING_BYTES,
+                 stallTimeout=resources.DEFAULT_STALL_TIMEOUT,
+                 interface=''):
+        self._count = count
+        self._args = ['--region', region, '--port', str(port),
+                      '--interface', interface, '--mount-point', mountPoint,
+                      '--fragment-max-age', str(fragmentMaxAge),
+                      '--max-outstanding-bytes', str(maxOutstandingBytes),
+                      '--stall-timeout', str(stallTimeout),
+                      '--parent', str(os.getpid())]
+        self._workers = []
+        self._stopping = False
+
+    def start(self):
+        for i in range(self._count):
+            self._spawn()
+
+    def _spawn(self):
+        if self._stopping:
+            return
+        paths = {}
+        for name, module in sys.modules.items():
+            if name.startswith('flumotion') and module and \
+                    hasattr(module, '__path__'):
+                paths[name] = list(module.__path__)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        args = [sys.executable, '-c', BOOTSTRAP % paths] + self._args
+        p = WorkerProcessProtocol(self)
+        reactor.spawnProcess(p, sys.executable, args, env=env)
+        self.info('Spawned HTTP worker %d', p.transport.pid)
+        self._workers.append(p)
+
+    def workerEnded(self, worker, reason):
+        self._workers.remove(worker)
+        if self._stopping:
+            return
+        self.warning('HTTP worker ended: %s, spawning it again',
+                     reason.getErrorMessage())
+        reactor.callLater(RESPAWN_DELAY, self._spawn)
+
+    def getCount(self):
+        return len(self._workers)
+
+    def stop(self):
+        self._stopping = True
+        for p in self._workers:
+            try:
+                p.transport.signalProcess('TERM')
+            except Exception, e:
+                self.debug('Could not stop worker: %s', e)
+
+
+def main(args):
+    parser = optparse.OptionParser()
+    parser.add_option('--region', help='path of the shared-memory region')
+    parser.add_option('--port', type='int', help='port to listen on')
+    parser.add_option('--interface', default='',
+                      help='interface to listen on')
+    parser.add_option('--mount-point', default='/')
+    parser.add_option('--fragment-max-age', type='int', default=0)
+    parser.add_option('--max-outstanding-bytes', type='int',
+                      default=resources.DEFAULT_MAX_OUTSTANDING_BYTES)
+    parser.add_option('--stall-timeout', type='float',
+                      default=resources.DEFAULT_STALL_TIMEOUT)
+    parser.add_option('--parent', type='int',
+                      help='exit once the process with this pid is gone')
+    options, args = parser.parse_args(args[1:])
+    log.init()
+
+    store = shmstore.SharedStoreReader(options.region)
+    site = server.Site(WorkerResource(store, options.mount_point,
+                                      options.fragment_max_age,
+                                      options.max_outstanding_bytes,
+                                      options.stall_timeout))
+    port = ReusePort(options.port, site, interface=options.interface,
+                     reactor=reactor)
+    port.startListening()
+
+    def checkParent():
+        if options.parent and os.getppid() != options.parent:
+            log.info('smooth-worker', 'Streamer %d is gone, exiting',
+                     options.parent)
+            reactor.stop()
+    task.LoopingCall(checkParent).start(PARENT_CHECK_INTERVAL)
+    reactor.run()
+    store.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -15,6 +15,8 @@
 #
 # Headers in this file shall remain intact.
 
+import gst
+
 from flumotion.component import feedcomponent
 from flumotion.common import gstreamer, messages, documentation
 from flumotion.common.i18n import N_, gettexter
@@ -58,4 +60,10 @@ class FMP4(feedcomponent.MuxerComponent):
         if self.duration:
             return '%s fragment-method=1 fragment-duration=%s' % \
                     (muxer, self.duration)
-        return '%s fragment-method=2 dts-method=2 ! flupacketizer' % muxer
+        packetizer = 'flupacketizer'
+        if 'max-fragment-duration' in props:
+            packetizer += ' max-duration=%d' % \
+                (props['max-fragment-duration'] * gst.MSECOND)
+        if 'max-fragment-size' in props:
+            packetizer += ' max-size=%d' % props['max-fragment-size']
+        return '%s fragment-method=2 dts-method=2 ! %s' % (muxer, packetizer)
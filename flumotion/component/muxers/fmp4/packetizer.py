@@ -15,9 +15,15 @@
 #
 # Headers in this file shall remain intact.
 
+import array
+
 import gst
 import gobject
 
+# no limits unless configured, GstForceKeyUnit events delimit fragments
+DEFAULT_MAX_DURATION = 0
+DEFAULT_MAX_SIZE = 0
+
 
 class Packetizer(gst.Element):
 
@@ -25,6 +31,18 @@ class Packetizer(gst.Element):
                       'Creates fragments delimited by GstForceKeyUnit events',
                       'Flumotion Dev Team')
 
+    __gproperties__ = {
+        'max-duration': (gobject.TYPE_UINT64, 'maximum duration',
+                         'Duration after which a fragment is pushed without '
+                         'waiting for a GstForceKeyUnit event (0 = no limit)',
+                         0, gst.CLOCK_TIME_NONE, DEFAULT_MAX_DURATION,
+                         gobject.PARAM_READWRITE),
+        'max-size': (gobject.TYPE_UINT, 'maximum size',
+                     'Size in bytes after which a fragment is pushed without '
+                     'waiting for a GstForceKeyUnit event (0 = no limit)',
+                     0, gobject.G_MAXUINT, DEFAULT_MAX_SIZE,
+                     gobject.PARAM_READWRITE)}
+
     _sinkpadtemplate = gst.PadTemplate("sink",
                                          gst.PAD_SINK,
                                          gst.PAD_ALWAYS,
@@ -46,15 +64,68 @@ class Packetizer(gst.Element):
         self.srcpad = gst.Pad(self._srcpadtemplate, "src")
         self.add_pad(self.srcpad)
 
+        self._max_duration = DEFAULT_MAX_DURATION
+        self._max_size = DEFAULT_MAX_SIZE
+        self._warned = False
         self._last_index = 0
         self._reset_fragment()
         self._caps = None
 
+    def do_get_property(self, prop):
+        if prop.name == 'max-duration':
+            return self._max_duration
+        elif prop.name == 'max-size':
+            return self._max_size
+        raise AttributeError('unknown property %s' % prop.name)
+
+    def do_set_property(self, prop, value):
+        if prop.name == 'max-duration':
+            self._max_duration = value
+        elif prop.name == 'max-size':
+            self._max_size = value
+        else:
+            raise AttributeError('unknown property %s' % prop.name)
+
     def _reset_fragment(self, last_event_ts=gst.CLOCK_TIME_NONE):
-        self._fragment = []
+        # the data of the buffers is appended as they arrive, only the last
+        # one is kept for its timestamp and duration. The data is copied
+        # twice: into the array, which grows by amortized reallocation,
+        # and into the buffer pushed downstream
+        self._fragment = array.array('c')
+        self._last = None
         self._first_ts = gst.CLOCK_TIME_NONE
         self._last_event_ts = last_event_ts
 
+    def _end_ts(self):
+        # the end of the fragment, from the timestamp of its last buffer
+        lb = self._last
+        if lb.timestamp == gst.CLOCK_TIME_NONE or \
+                lb.duration == gst.CLOCK_TIME_NONE:
+            return lb.timestamp
+        return lb.timestamp + lb.duration
+
+    def _exceeds_limits(self):
+        if self._max_size and len(self._fragment) >= self._max_size:
+            return True
+        end = self._end_ts()
+        if not self._max_duration or \
+                self._first_ts == gst.CLOCK_TIME_NONE or \
+                end == gst.CLOCK_TIME_NONE:
+            return False
+        return end - self._first_ts >= self._max_duration
+
+    def _push_fragment(self, event_ts=gst.CLOCK_TIME_NONE):
+        # gst.Buffer copies the data straight from the array
+        buf = gst.Buffer(self._fragment)
+        buf.timestamp = self._first_ts
+        lb = self._last
+        if lb.duration != gst.CLOCK_TIME_NONE:
+            buf.duration = lb.timestamp + lb.duration - self._first_ts
+        elif event_ts != gst.CLOCK_TIME_NONE:
+            buf.duration = event_ts - self._last_event_ts
+        buf.set_caps(self._caps)
+        return self.srcpad.push(buf)
+
     def setcaps(self, pad, caps):
         self._caps = caps
         return self.srcpad.set_caps(caps)
@@ -66,17 +137,38 @@ class Packetizer(gst.Element):
         if buf.timestamp != gst.CLOCK_TIME_NONE and \
                 self._first_ts == gst.CLOCK_TIME_NONE:
             self._first_ts = buf.timestamp
-        self._fragment.append(buf)
-        return gst.FLOW_OK
+        # read through the buffer interface, without a .data string
+        self._fragment.fromstring(buf)
+        self._last = buf
+        if not self._exceeds_limits():
+            return gst.FLOW_OK
+
+        if not self._warned:
+            self._warned = True
+            msg = ("No GstForceKeyUnit event received in %s or %d bytes, "
+                   "pushing fragments at these limits" %
+                   (gst.TIME_ARGS(self._max_duration), self._max_size))
+            self.warning(msg)
+            self.post_message(gst.message_new_warning(self,
+                gst.GError(gst.STREAM_ERROR, gst.STREAM_ERROR_FAILED, msg),
+                msg))
+        # the next fragment starts where the pushed one ends
+        end = self._end_ts()
+        if end == gst.CLOCK_TIME_NONE:
+            end = self._last_event_ts
+        ret = self._push_fragment()
+        self._reset_fragment(end)
+        return ret
 
     def eventfunc(self, pad, event):
         s = event.get_structure()
         if event.type != gst.EVENT_CUSTOM_DOWNSTREAM or \
                 s.get_name() != 'GstForceKeyUnit':
             return pad.event_default(event)
+        self._warned = False
 
         if self._last_event_ts == gst.CLOCK_TIME_NONE or \
-            len(self._fragment) == 0:
+            self._last is None:
             self._reset_fragment(s['timestamp'])
             return True
 
@@ -90,18 +182,9 @@ class Packetizer(gst.Element):
         self._last_index = index
 
         # Create the new fragment and send it downstream
-        data = ''.join([b.data for b in self._fragment])
-        buf = gst.Buffer(data)
-        buf.timestamp = self._first_ts
-        lb = self._fragment[-1]
-        if lb.duration != gst.CLOCK_TIME_NONE:
-            buf.duration = lb.timestamp + lb.duration - self._first_ts
-        else:
-            buf.duration = s['timestamp'] - self._last_event_ts
-        buf.set_caps(self._caps)
-
+        ret = self._push_fragment(s['timestamp'])
         self._reset_fragment(s['timestamp'])
-        return self.srcpad.push(buf)
+        return ret
 
 
 def register():
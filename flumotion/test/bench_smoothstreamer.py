@@ -0,0 +1,356 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Micro-benchmarks of the hot paths of the smooth streamer: fragment
+ingest, manifest rendering and fragment lookup and serving. They run on
+synthetic fMP4 buffers, without a GStreamer pipeline.
+
+    python bench_smoothstreamer.py --windows 20,3600 --qualities 1,12 \
+        --output after.json --compare before.json
+
+Results are written as JSON, one entry per DVR window and number of
+qualities, so runs can be compared.
+"""
+
+import setup
+setup.setup()
+
+import math
+import optparse
+import platform
+import random
+import struct
+import sys
+import time
+from cStringIO import StringIO
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from mp4seek import atoms
+
+from flumotion.common import log
+from flumotion.component.consumers.smoothstreamer.smoothstreamer import \
+    FragmentStore
+from flumotion.component.consumers.smoothstreamer.resources import \
+    FragmentWriterMixin, WriteStats
+
+DEFAULT_WINDOWS = '20,300,3600,14400'
+DEFAULT_QUALITIES = '1,4,12'
+DEFAULT_FRAGMENT_DURATION = 2
+DEFAULT_FRAGMENT_SIZE = 4096
+DEFAULT_STEADY_FRAGMENTS = 500
+DEFAULT_BUDGET = 0.5
+TIMESCALE = 10000000
+SINK = 'sink_bench'
+WIDTH, HEIGHT = 640, 360
+SPS = '\x67\x4d\x40\x1e\x96\x52\x05\x01\x6c\x80'
+PPS = '\x68\xeb\x8f\x20'
+MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+SAMPLES = 50
+
+
+def box(type, payload):
+    return struct.pack('>I4s', len(payload) + 8, type) + payload
+
+
+def full_box(type, version, flags, payload):
+    return box(type, struct.pack('>I', version << 24 | flags) + payload)
+
+
+def make_trak(track_id, bitrate):
+    tkhd = full_box('tkhd', 0, 7,
+        struct.pack('>IIIII', 0, 0, track_id, 0, 0) + '\0' * 8 +
+        struct.pack('>hhhH', 0, 0, 0, 0) + MATRIX +
+        struct.pack('>II', WIDTH << 16, HEIGHT << 16))
+    mdhd = full_box('mdhd', 0, 0,
+        struct.pack('>IIIIHH', 0, 0, TIMESCALE, 0, 0x55c4, 0))
+    hdlr = full_box('hdlr', 0, 0,
+        struct.pack('>I4s', 0, 'vide') + '\0' * 12 + 'video\0')
+    avcC = box('avcC', struct.pack('>6B', 1, 0x4d, 0x40, 0x1e, 0xff, 0xe1) +
+               struct.pack('>H', len(SPS)) + SPS +
+               struct.pack('>BH', 1, len(PPS)) + PPS)
+    btrt = box('btrt', struct.pack('>III', 0, bitrate, bitrate))
+    avc1 = box('avc1', '\0' * 6 + struct.pack('>H', 1) + '\0' * 16 +
+               struct.pack('>HHIIIH', WIDTH, HEIGHT, 0x480000, 0x480000,
+                           0, 1) +
+               '\0' * 32 + struct.pack('>Hh', 0x18, -1) + avcC + btrt)
+    empty = lambda type: full_box(type, 0, 0, struct.pack('>I', 0))
+    stbl = box('stbl', full_box('stsd', 0, 0, struct.pack('>I', 1) + avc1) +
+               empty('stts') + empty('stsc') +
+               full_box('stsz', 0, 0, struct.pack('>II', 0, 0)) +
+               empty('stco'))
+    dinf = box('dinf', full_box('dref', 0, 0,
+                                struct.pack('>I', 1) +
+                                full_box('url ', 0, 1, '')))
+    minf = box('minf', full_box('vmhd', 0, 1, '\0' * 8) + dinf + stbl)
+    return box('trak', tkhd + box('mdia', mdhd + hdlr + minf))
+
+
+def make_moov(bitrates):
+    """
+    Returns a moov with a video track for each bitrate.
+    """
+    mvhd = full_box('mvhd', 0, 0,
+        struct.pack('>IIII', 0, 0, TIMESCALE, 0) +
+        struct.pack('>IH', 0x10000, 0x100) + '\0' * 10 + MATRIX +
+        '\0' * 24 + struct.pack('>I', len(bitrates) + 1))
+    traks = [make_trak(i + 1, b) for i, b in enumerate(bitrates)]
+    mvex = box('mvex', ''.join([full_box('trex', 0, 0,
+                                         struct.pack('>5I', i + 1, 1, 0, 0, 0))
+                                for i in range(len(bitrates))]))
+    return box('moov', mvhd + ''.join(traks) + mvex)
+
+
+def make_fragment(track_id, duration, size):
+    """
+    Returns a moof and mdat of size bytes with SAMPLES samples.
+    """
+    sampleSize = size / SAMPLES
+    samples = struct.pack('>II', duration / SAMPLES, sampleSize) * SAMPLES
+    mfhd = full_box('mfhd', 0, 0, struct.pack('>I', 1))
+    tfhd = full_box('tfhd', 0, 0, struct.pack('>I', track_id))
+    moofSize = 8 + len(mfhd) + 8 + len(tfhd) + 20 + len(samples)
+    # data offset and duration and size of every sample
+    trun = full_box('trun', 0, 0x301,
+        struct.pack('>Ii', SAMPLES, moofSize + 8) + samples)
+    moof = box('moof', mfhd + box('traf', tfhd + trun))
+    return moof + box('mdat', '\0' * sampleSize * SAMPLES)
+
+
+class BenchRequest(object):
+    """
+    A request whose transport sends everything straight away.
+    """
+
+    method = 'GET'
+
+    def __init__(self):
+        self.transport = self
+        self.producer = None
+        self.written = 0
+
+    def getHeader(self, name):
+        return None
+
+    def setHeader(self, name, value):
+        pass
+
+    def setETag(self, etag):
+        return None
+
+    def setLastModified(self, when):
+        return None
+
+    def setResponseCode(self, code):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        while self.producer:
+            producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.written += len(data)
+
+    def loseConnection(self):
+        pass
+
+
+class BenchWriter(log.Loggable, FragmentWriterMixin):
+
+    def __init__(self, store):
+        self.store = store
+        self.bytesSent = 0
+        self._fragmentMaxAge = 3600
+        self._writeStats = WriteStats()
+        self._maxOutstandingBytes = 256 * 1024
+        self._stallTimeout = 30
+
+
+def measure(func, budget=DEFAULT_BUDGET):
+    """
+    Call func repeatedly for about budget seconds.
+
+    @returns: the number of calls and the mean time of a call in seconds
+    """
+    calls = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < budget:
+        func()
+        calls += 1
+        elapsed = time.time() - start
+    return calls, elapsed / calls
+
+
+def run_case(window, qualities, fragmentDuration=DEFAULT_FRAGMENT_DURATION,
+             fragmentSize=DEFAULT_FRAGMENT_SIZE,
+             steadyFragments=DEFAULT_STEADY_FRAGMENTS,
+             budget=DEFAULT_BUDGET):
+    """
+    Fill a store with a DVR window of window seconds of the given number
+    of qualities and measure its hot paths.
+
+    @rtype: dict
+    """
+    store = FragmentStore()
+    store.setDVRWindowLength(window)
+    bitrates = [300000 + i * 100000 for i in range(qualities)]
+    moovd = atoms.atoms_dict(list(atoms.read_atoms(
+        StringIO(make_moov(bitrates)))))
+    # addMoov prints the moov
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        store.addMoov(SINK, moovd)
+    finally:
+        sys.stdout = stdout
+
+    duration = fragmentDuration * TIMESCALE
+    fragments = [make_fragment(i + 1, duration, fragmentSize)
+                 for i in range(qualities)]
+    state = {'next': 0}
+
+    def ingest(count):
+        start = time.time()
+        for i in xrange(count):
+            ts = state['next'] * duration
+            for f in fragments:
+                store.addFragment(SINK, f, ts, duration)
+            state['next'] += 1
+        return count * qualities / (time.time() - start)
+
+    # the lookahead fragments are not published
+    fill = int(math.ceil(float(window) / fragmentDuration)) + \
+        store.LookAheadFragmentCount + 1
+    result = {'window': window, 'qualities': qualities,
+              'fragment-duration': fragmentDuration,
+              'fragment-size': fragmentSize}
+    result['ingest-fill-rate'] = ingest(fill)
+    result['ingest-steady-rate'] = ingest(steadyFragments)
+
+    manifest = store.renderManifest()
+    result['manifest-bytes'] = len(manifest)
+    calls, t = measure(store.renderManifest, budget)
+    result['manifest-render-ms'] = t * 1000
+
+    def gzipped():
+        store.invalidateManifest()
+        store.getManifest('gzip')
+    store.setManifestEncodings(['gzip'])
+    calls, t = measure(gzipped, budget)
+    result['manifest-gzip-ms'] = t * 1000
+
+    paths = []
+    for stream in store._streams.values():
+        for bitrate, q in stream.getQualities():
+            for ts, f in q.getFragments():
+                paths.extend([p for p, kind in q.getFragmentPaths(ts)])
+    rand = random.Random(0)
+    lookups = [rand.choice(paths) for i in xrange(1000)]
+    state['i'] = 0
+
+    def lookup():
+        state['i'] = (state['i'] + 1) % len(lookups)
+        return store.lookup(lookups[state['i']])
+    calls, t = measure(lookup, budget)
+    result['lookup-rate'] = 1 / t
+
+    writer = BenchWriter(store)
+
+    def serve():
+        fragment, kind, mime = lookup()
+        writer._writeFragmentBody(BenchRequest(), fragment, kind)
+    calls, t = measure(serve, budget)
+    result['serve-rate'] = 1 / t
+    result['serve-mbytes-per-second'] = \
+        writer.bytesSent / (calls * t) / (1024 * 1024)
+    store.close()
+    return result
+
+
+def compare(results, baseline):
+    """
+    Returns the lines of a comparison of results with the ones of
+    baseline, as the ratio of each measure.
+    """
+    old = {}
+    for r in baseline['results']:
+        old[(r['window'], r['qualities'])] = r
+    lines = []
+    for r in results['results']:
+        b = old.get((r['window'], r['qualities']))
+        if not b:
+            continue
+        for k in sorted(r):
+            if k.endswith('-rate') or k.endswith('-ms'):
+                if b.get(k):
+                    lines.append('window=%-6d qualities=%-3d %-26s %.2fx'
+                                 % (r['window'], r['qualities'], k,
+                                    r[k] / b[k]))
+    return lines
+
+
+def main(args):
+    parser = optparse.OptionParser()
+    parser.add_option('--windows', default=DEFAULT_WINDOWS,
+                      help='DVR windows in seconds (default: %default)')
+    parser.add_option('--qualities', default=DEFAULT_QUALITIES,
+                      help='numbers of qualities (default: %default)')
+    parser.add_option('--fragment-duration', type='int',
+                      default=DEFAULT_FRAGMENT_DURATION)
+    parser.add_option('--fragment-size', type='int',
+                      default=DEFAULT_FRAGMENT_SIZE)
+    parser.add_option('--budget', type='float', default=DEFAULT_BUDGET,
+                      help='seconds spent on each measure')
+    parser.add_option('--output', help='file the results are written to')
+    parser.add_option('--compare', help='results of a previous run')
+    options, args = parser.parse_args(args[1:])
+
+    results = {'python': platform.python_version(),
+               'time': int(time.time()), 'results': []}
+    for window in [int(w) for w in options.windows.split(',')]:
+        for qualities in [int(q) for q in options.qualities.split(',')]:
+            r = run_case(window, qualities, options.fragment_duration,
+                         options.fragment_size, budget=options.budget)
+            results['results'].append(r)
+            sys.stderr.write('window=%d qualities=%d done\n'
+                             % (window, qualities))
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output)
+        f.close()
+    else:
+        print output
+    if options.compare:
+        f = open(options.compare)
+        baseline = json.load(f)
+        f.close()
+        for line in compare(results, baseline):
+            sys.stderr.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
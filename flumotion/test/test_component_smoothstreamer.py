@@ -18,7 +18,18 @@
 import setup
 setup.setup()
 
+import array
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+
+import gst
+from twisted.internet import defer, reactor, task
 from twisted.trial import unittest
+from twisted.web import resource, server
 try:
     from twisted.web import client
 except ImportError:
@@ -26,10 +37,18 @@ except ImportError:
 
 from flumotion.common import log, testsuite, netutils, gstreamer
 from flumotion.common.planet import moods
-from flumotion.test import comptest
+from flumotion.test import bench_smoothstreamer, comptest
 
 from flumotion.component.consumers.smoothstreamer.smoothstreamer \
-    import SmoothHTTPLiveStreamer
+    import SmoothHTTPLiveStreamer, FragmentStore, Fragment, FragmentRing
+from flumotion.component.consumers.smoothstreamer.resources \
+    import parseAcceptEncoding, parseRange, RangeNotSatisfiable, \
+    parseFragmentPath, FragmentProducer, WriteStats, ClientStalled
+from flumotion.component.consumers.smoothstreamer import aggregator, \
+    boxes, buffers, disktier, edge, handoff, ingest, shmstore, timing, \
+    worker
+from flumotion.component.common.streamer.fragmentedresource import \
+    FragmentNotFound
 
 attr = testsuite.attr
 
@@ -103,6 +122,1104 @@ class TestSmoothStreamerDataPlug(SmoothStreamerTestCase):
     testGetStreamData.skip = 'See #1137'
 
 
+class TestManifestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FragmentStore()
+
+    def testManifestIsRenderedOnce(self):
+        manifest, etag = self.store.getManifest()
+        again, sameEtag = self.store.getManifest()
+        self.failUnless(manifest is again)
+        self.assertEquals(etag, sameEtag)
+        self.failUnless(etag.startswith('"') and etag.endswith('"'))
+
+    def testInvalidate(self):
+        manifest, etag = self.store.getManifest()
+        self.store.Duration = 10
+        # not rendered again until the store invalidates it
+        self.assertEquals(self.store.getManifest()[1], etag)
+        self.store.invalidateManifest()
+        newManifest, newEtag = self.store.getManifest()
+        self.failIfEquals(etag, newEtag)
+        self.failUnless('Duration="10"' in newManifest)
+
+    def testCompressedVariants(self):
+        self.store.setManifestEncodings(['gzip', 'deflate'])
+        manifest, etag = self.store.getManifest()
+        gzipped, gzipEtag = self.store.getManifest('gzip')
+        deflated, deflateEtag = self.store.getManifest('deflate')
+        self.assertEquals(zlib.decompress(gzipped, 16 + zlib.MAX_WBITS),
+                          manifest)
+        self.assertEquals(zlib.decompress(deflated), manifest)
+        self.assertEquals(len(set([etag, gzipEtag, deflateEtag])), 3)
+        self.failUnless(self.store.getManifest('gzip')[0] is gzipped)
+
+    def testParseAcceptEncoding(self):
+        self.assertEquals(parseAcceptEncoding('gzip, deflate'),
+                          {'gzip': 1.0, 'deflate': 1.0})
+        self.assertEquals(parseAcceptEncoding('GZIP;q=0, *;q=0.5'),
+                          {'gzip': 0.0, '*': 0.5})
+        self.assertEquals(parseAcceptEncoding(' ,identity;q=bad'),
+                          {'identity': 0.0})
+
+
+def box(type, payload):
+    return struct.pack('>I4s', len(payload) + 8, type) + payload
+
+
+def fragment(track_id, payload='\x00' * 16):
+    tfhd = box('tfhd', struct.pack('>II', 0, track_id))
+    moof = box('moof', box('mfhd', struct.pack('>II', 0, 1)) +
+                       box('traf', tfhd))
+    return moof + box('mdat', payload)
+
+
+class TestBoxes(unittest.TestCase):
+
+    def testIterBoxes(self):
+        data = fragment(3)
+        types = [b[0] for b in boxes.iter_boxes(data)]
+        self.assertEquals(types, ['moof', 'mdat'])
+
+    def testMoveDataOffsets(self):
+        data = bench_smoothstreamer.make_fragment(1, 20000000, 500)
+        offset, header, size = boxes.find_box(data, ('moof', 'traf'))
+        # a box added at the end of the traf, its offsets left as they were
+        extra = box('uuid', '\0' * 24)
+        moof = box('moof', data[8:offset] +
+                           box('traf', data[offset + header:offset + size] +
+                                       extra))
+        self.assertEquals(trun_data_offset(moof), trun_data_offset(data))
+        moof = boxes.move_data_offsets(data, moof)
+        self.assertEquals(trun_data_offset(moof),
+                          trun_data_offset(data) + len(extra))
+        self.assertEquals(trun_data_offset(moof), len(moof) + 8)
+
+    def testGetTrackId(self):
+        self.assertEquals(boxes.get_track_id(fragment(3)), 3)
+        self.assertEquals(boxes.get_track_id(box('moov', '')), None)
+
+    def testTruncated(self):
+        self.assertRaises(ValueError, boxes.get_track_id, fragment(3)[:20])
+
+    def testSetTrackId(self):
+        data = array.array('c', fragment(1, 'payload'))
+        self.failUnless(boxes.set_track_id(data, 7))
+        self.assertEquals(data.tostring(), fragment(7, 'payload'))
+        self.failIf(boxes.set_track_id(array.array('c', box('moov', '')), 7))
+
+    def testGetSampleDescription(self):
+        stsd = box('stsd', struct.pack('>II', 0, 1) + box('avc1', 'config'))
+        stbl = box('stbl', stsd + box('stts', '\x00' * 8))
+        trak = box('trak', box('tkhd', '') +
+                   box('mdia', box('minf', stbl)))
+        moov = box('moov', box('mvhd', '') + trak)
+        self.assertEquals(boxes.get_sample_description(moov), stsd)
+        self.assertEquals(boxes.get_sample_description(fragment(1)), None)
+
+
+class TestFragmentRing(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = FragmentRing()
+        for t in range(0, 100, 10):
+            self.ring.append(Fragment(t, 10, ['%d' % t], 0))
+
+    def testLookup(self):
+        self.assertEquals(self.ring.get(30).parts, ['30'])
+        self.assertEquals(self.ring.get(35), None)
+        self.assertEquals(self.ring.get(1000), None)
+
+    def testEviction(self):
+        self.assertEquals(self.ring.duration, 100)
+        self.assertEquals(self.ring.window(), 90)
+        for t in range(0, 80, 10):
+            self.assertEquals(self.ring.popleft().timestamp, t)
+        self.assertEquals(len(self.ring), 2)
+        self.assertEquals(self.ring.duration, 20)
+        self.assertEquals(self.ring.get(70), None)
+        self.assertEquals(self.ring.first().timestamp, 80)
+        self.assertEquals([f.timestamp for f in self.ring], [80, 90])
+
+    def testOutOfOrder(self):
+        self.ring.append(Fragment(45, 5, ['45'], 0))
+        self.ring.append(Fragment(50, 10, ['new'], 0))
+        self.assertEquals(self.ring.get(50).parts, ['new'])
+        self.assertEquals(self.ring.duration, 105)
+        timestamps = [f.timestamp for f in self.ring]
+        self.assertEquals(timestamps, sorted(timestamps))
+
+    def testRemove(self):
+        self.assertEquals(self.ring.remove(0).timestamp, 0)
+        self.assertEquals(self.ring.remove(50).timestamp, 50)
+        self.assertEquals(self.ring.duration, 80)
+        self.assertEquals(self.ring.get(50), None)
+        self.assertRaises(KeyError, self.ring.remove, 55)
+        self.assertRaises(KeyError, self.ring.remove, 1000)
+        self.assertRaises(KeyError, FragmentRing().remove, 0)
+        self.assertEquals(len(self.ring), 8)
+
+
+class TestStreamTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FragmentStore()
+        self.store.DVRWindowLength = 30
+        self.stream = self.store.getStream('video', 10)
+        # two qualities with the same fragments
+        for i in range(2):
+            for t in range(0, 50, 10):
+                self.stream.addChunk(t, 10)
+
+    def chunks(self):
+        return [c.timestamp for c in self.stream.getChunks()]
+
+    def testChunksInWindow(self):
+        self.assertEquals(self.chunks(), [10, 20, 30, 40])
+
+    def testRemoveChunk(self):
+        self.stream.removeChunk(10)
+        self.assertEquals(self.chunks(), [10, 20, 30, 40])
+        self.stream.removeChunk(10)
+        self.assertEquals(self.chunks(), [20, 30, 40])
+
+    def testManifest(self):
+        manifest = self.store.renderManifest()
+        self.failUnless('<c t="10" />\n    <c t="20" />' in manifest)
+        self.failIf('<c t="0" />' in manifest)
+
+
+class TestRanges(unittest.TestCase):
+
+    def testParseRange(self):
+        self.assertEquals(parseRange('bytes=0-3', 15), (0, 4))
+        self.assertEquals(parseRange('bytes=5-', 15), (5, 15))
+        self.assertEquals(parseRange('bytes=-4', 15), (11, 15))
+        self.assertEquals(parseRange('bytes=3-100', 15), (3, 15))
+
+    def testIgnoredRanges(self):
+        for header in ['bytes=1-2,4-5', 'items=1-2', 'bytes=4-2', 'bytes=x-']:
+            self.assertEquals(parseRange(header, 15), None)
+
+    def testNotSatisfiable(self):
+        self.assertRaises(RangeNotSatisfiable, parseRange, 'bytes=15-', 15)
+        self.assertRaises(RangeNotSatisfiable, parseRange, 'bytes=-0', 15)
+
+    def testChunks(self):
+        parts = ['abcd', 'efghij', 'klmno']
+        data = ''.join(parts)
+        for start in range(len(data)):
+            for end in range(start, len(data) + 1):
+                chunks = buffers.iter_chunks(parts, start, end, 2)
+                self.assertEquals(''.join(chunks), data[start:end])
+        # whole string parts are not copied
+        self.failUnless(list(buffers.iter_chunks(parts, 4, 10))[0]
+                        is parts[1])
+
+    def testBufferParts(self):
+        parts = ['abcd', buffer('xxefghijxx', 2, 6), 'klmno']
+        self.assertEquals(buffers.parts_size(parts), 15)
+        self.assertEquals(''.join(buffers.iter_chunks(parts, 2, 12, 3)),
+                          'cdefghijkl')
+        self.assertEquals(''.join(buffers.iter_chunks(
+            buffers.prefix(parts, 7))), 'abcdefg')
+
+    def testPrefix(self):
+        parts = ['abcd', 'efghij']
+        for size in range(11):
+            prefix = buffers.prefix(parts, size)
+            self.assertEquals(''.join(buffers.iter_chunks(prefix)),
+                              'abcdefghij'[:size])
+        self.failUnless(buffers.prefix(parts, 4)[0] is parts[0])
+
+
+class FakeRequest(object):
+
+    def __init__(self):
+        self.transport = self
+        self.written = []
+        self.producer = None
+        self.lost = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.written.append(data)
+
+    def loseConnection(self):
+        self.lost = True
+
+
+class FakeManifestStore(object):
+
+    def isReady(self):
+        return True
+
+    def getManifestEncodings(self):
+        return []
+
+    def getManifest(self, encoding=None):
+        return '<manifest/>', '"1"'
+
+    def getManifestMaxAge(self):
+        return 2
+
+
+class FakeHTTPRequest(FakeRequest):
+
+    method = 'GET'
+
+    def __init__(self, path):
+        FakeRequest.__init__(self)
+        self.path = path
+        self.code = 200
+        self.headers = {}
+        self.finished = False
+
+    def getHeader(self, name):
+        return None
+
+    def setHeader(self, name, value):
+        self.headers[name.lower()] = value
+
+    def setETag(self, etag):
+        return None
+
+    def setLastModified(self, when):
+        return None
+
+    def setResponseCode(self, code):
+        self.code = code
+
+    def finish(self):
+        self.finished = True
+
+
+class TestWorkerResource(unittest.TestCase):
+
+    def testMountPointWithoutSlash(self):
+        res = worker.WorkerResource(FakeManifestStore(), '/smooth', 60)
+        request = FakeHTTPRequest('/smooth/Manifest')
+        res.render_GET(request)
+        self.assertEquals(request.code, 200)
+        self.assertEquals(request.written, ['<manifest/>'])
+        self.failUnless(request.finished)
+
+
+class TestFragmentProducer(unittest.TestCase):
+
+    def setUp(self):
+        self.request = FakeRequest()
+        self.stats = WriteStats()
+
+    def testOutstanding(self):
+        producer = FragmentProducer(self.request, iter(['a' * 10] * 10),
+                                    self.stats, 25, 60)
+        d = producer.start()
+        # the transport didn't ask for more yet
+        self.assertEquals(len(self.request.written), 3)
+        self.assertEquals(self.stats.active, 1)
+        while self.request.producer:
+            self.request.producer.resumeProducing()
+        d.addCallback(self.assertEquals, 100)
+        d.addCallback(lambda _: self.assertEquals(self.stats.asDict(),
+            {'active': 0, 'completed': 1, 'stalled': 0, 'lost': 0}))
+        return d
+
+    def testLargePart(self):
+        part = 'a' * (4 * 1024 * 1024)
+        producer = FragmentProducer(self.request,
+                                    buffers.iter_chunks([part]),
+                                    self.stats, 256 * 1024, 60)
+        d = producer.start()
+        # a big part is written in chunks, not at once
+        self.assertEquals([len(c) for c in self.request.written],
+                          [buffers.CHUNK_SIZE] * 4)
+        while self.request.producer:
+            self.request.producer.resumeProducing()
+        d.addCallback(self.assertEquals, len(part))
+        d.addCallback(lambda _: self.assertEquals(
+            ''.join(self.request.written), part))
+        return d
+
+    def testStalled(self):
+        producer = FragmentProducer(self.request, iter(['a' * 10] * 10),
+                                    self.stats, 10, 0.01)
+        d = self.assertFailure(producer.start(), ClientStalled)
+        d.addCallback(lambda _: self.failUnless(self.request.lost))
+        d.addCallback(lambda _: self.assertEquals(self.stats.stalled, 1))
+        return d
+
+
+class TestFragmentWait(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FragmentStore()
+        self.store.DVRWindowLength = 100
+        stream = self.store.getStream('video', 10)
+        self.quality = stream.getQuality(self.store, 1000)
+        self.quality.setStream(stream)
+        self.quality.setTrackId(1)
+
+    def testPublishWakesWaiters(self):
+        d = self.quality.waitFragment(10, 60)
+        self.quality.publishFragment(Fragment(10, 10, ['data'], 0))
+        d.addCallback(lambda _:
+            self.assertEquals(self.quality.getFragment(10).parts, ['data']))
+        return d
+
+    def testETag(self):
+        self.quality.publishFragment(Fragment(10, 10, ['data'], 2))
+        fragment = self.quality.getFragment(10)
+        self.assertEquals(fragment.getETag(), '"1-1000-10"')
+        self.assertEquals(fragment.getETag('info'), '"1-1000-10-info"')
+        self.failIf(fragment.published is None)
+
+    def testLookup(self):
+        self.store.DVRWindowLength = 10
+        for t in (0, 10, 20):
+            self.quality.publishFragment(Fragment(t, 10, ['data'], 2))
+        fragment, kind, mime = self.store.lookup(
+            'QualityLevels(1000)/Fragments(video=20)')
+        self.assertEquals((fragment.timestamp, kind), (20, 'fragment'))
+        fragment, kind, mime = self.store.lookup(
+            'QualityLevels(1000)/FragmentInfo(video=10)')
+        self.assertEquals((fragment.timestamp, kind), (10, 'info'))
+        # evicted
+        self.assertEquals(self.store.lookup(
+            'QualityLevels(1000)/Fragments(video=0)'), None)
+
+    def testTimeout(self):
+        d = self.quality.waitFragment(10, 0.01)
+        d.addCallback(lambda _:
+            self.assertEquals(self.quality.getFragment(10), None))
+        return d
+
+
+def trun_data_offset(data):
+    offset, header, size = boxes.find_box(data, ('moof', 'traf', 'trun'))
+    # after the version, flags and sample count
+    return struct.unpack_from('>i', data, offset + header + 8)[0]
+
+
+class TestIngest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = bench_smoothstreamer.make_fragment(1, 20000000, 500)
+        # the samples start right after the mdat header
+        self.assertEquals(trun_data_offset(self.data),
+                          boxes.get_moof_size(self.data) + 8)
+
+    def testLiveFragmentOffsets(self):
+        data, moofSize = ingest.make_live_fragment(
+            self.data, 0, 20000000, [(20000000, 20000000)])
+        self.assertEquals(moofSize, boxes.get_moof_size(data))
+        offset = trun_data_offset(data)
+        self.assertEquals(offset, moofSize + 8)
+        self.assertEquals(data[offset:], self.data[trun_data_offset(
+            self.data):])
+
+    def testLiveMoofOffsets(self):
+        moof, offset, size = ingest.make_live_moof(
+            self.data, 0, 20000000, [(20000000, 20000000)])
+        self.assertEquals(trun_data_offset(moof), len(moof) + 8)
+        self.assertEquals(self.data[offset:offset + size][:8],
+                          struct.pack('>I4s', size, 'mdat'))
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, func, *args):
+        d = defer.Deferred()
+        self.jobs.append(d)
+        return d
+
+
+class TestIngestOrder(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakePool()
+        self.store = FragmentStore()
+        self.store.DVRWindowLength = 100
+        self.store.setIngestPool(self.pool)
+        stream = self.store.getStream('video', 10)
+        self.quality = stream.getQuality(self.store, 1000)
+        self.quality.setStream(stream)
+        self.quality.setTrackId(1)
+
+    def testOutOfOrder(self):
+        for i in range(5):
+            self.quality.addFragment('f%d' % i, i * gst.SECOND, gst.SECOND)
+        # the last two are held as lookahead
+        self.assertEquals(len(self.pool.jobs), 3)
+        waiter = self.quality.waitFragment(10, 60)
+        first, failed, last = self.pool.jobs
+        last.callback(('f2', 0))
+        failed.errback(ValueError('broken fragment'))
+        self.assertEquals(self.quality.getFragmentCount(), 0)
+        self.failIf(waiter.called)
+
+        first.callback(('f0', 0))
+        # published in order, without the failed one, whose waiters are
+        # woken up
+        self.assertEquals([(ts, f.parts) for ts, f in
+                           self.quality.getFragments()],
+                          [(0, ['f0']), (20, ['f2'])])
+        self.failUnless(waiter.called)
+        self.failIf(self.quality.getFragmentInLookAhead(10))
+
+
+class TestDiskTier(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.segments = disktier.SegmentStore(self.directory, 10)
+
+    def tearDown(self):
+        self.segments.close()
+        shutil.rmtree(self.directory)
+
+    def testDemote(self):
+        f = Fragment(0, 10, ['moof', 'mdat' * 10], 4)
+        f.demote(self.segments)
+        self.failUnless(f.demoted)
+        self.assertEquals(len(f.parts), 2)
+        self.assertEquals(''.join(buffers.iter_chunks(f.parts, chunk_size=7)),
+                          'moof' + 'mdat' * 10)
+        self.assertEquals(''.join(buffers.iter_chunks(f.getParts('info'))),
+                          'moof')
+
+    def testDemoteBuffer(self):
+        f = Fragment(0, 10, ['moof', buffer('xxmdatxx', 2, 4)], 4)
+        f.demote(self.segments)
+        self.assertEquals(''.join(buffers.iter_chunks(f.parts)), 'moofmdat')
+
+    def testSegmentRemoved(self):
+        first = Fragment(0, 10, ['a' * 10], 0)
+        first.demote(self.segments)
+        second = Fragment(10, 10, ['b' * 10], 0)
+        second.demote(self.segments)
+        # the first segment is full, it's removed once released
+        path = first.parts[0].segment.path
+        self.failUnless(os.path.exists(path))
+        first.release()
+        self.failIf(os.path.exists(path))
+        self.assertEquals(second.parts[0].read(), 'b' * 10)
+
+    def testEvictedWhileWritten(self):
+        data = 'a' * (3 * buffers.CHUNK_SIZE)
+        first = Fragment(0, 10, [data], 0)
+        first.demote(self.segments)
+        Fragment(10, 10, ['b' * 10], 0).demote(self.segments)
+        path = first.parts[0].segment.path
+        writer = bench_smoothstreamer.BenchWriter(None)
+        writer._maxOutstandingBytes = buffers.CHUNK_SIZE
+        request = FakeHTTPRequest('/Fragments')
+        d = writer._writeFragmentBody(request, first, None)
+        self.assertEquals(len(request.written), 1)
+        # the client keeps reading the segment after the eviction
+        first.release()
+        self.failUnless(os.path.exists(path))
+        while request.producer:
+            request.producer.resumeProducing()
+        d.addCallback(lambda _: self.assertEquals(''.join(request.written),
+                                                  data))
+        d.addCallback(lambda _: self.failIf(os.path.exists(path)))
+        return d
+
+    def _quality(self, ramWindow, maxBytes=0):
+        store = FragmentStore()
+        store.DVRWindowLength = 1000
+        store.setDiskTier(self.directory, ramWindow)
+        store.setMaxBytes(maxBytes)
+        self.addCleanup(store.close)
+        stream = store.getStream('video', 10)
+        quality = stream.getQuality(store, 1000)
+        quality.setStream(stream)
+        quality.setTrackId(1)
+        store._qualities[('sink', 1)] = quality
+        return store, quality
+
+    def testDemoteInThread(self):
+        store, quality = self._quality(0)
+        for t in (0, 10):
+            quality.publishFragment(Fragment(t, 10, ['a' * 10], 0))
+        first = quality.getFragment(0)
+        # counted on disk, but served from memory until written
+        self.failUnless(first.demoting)
+        self.failIf(first.demoted)
+        self.assertEquals(store.getRAMBytes(), 10)
+
+        def check():
+            if not first.demoted:
+                return task.deferLater(reactor, 0.01, check)
+            self.assertEquals(first.parts[0].read(), 'a' * 10)
+            self.assertEquals(store.getDiskBytes(), 10)
+        return check()
+
+    def testMaxBytesDemotes(self):
+        store, quality = self._quality(1000, maxBytes=25)
+        for t in (0, 10, 20):
+            quality.publishFragment(Fragment(t, 10, ['a' * 10], 0))
+        # the oldest one is moved to disk instead of being evicted
+        self.assertEquals(quality.getFragmentCount(), 3)
+        self.failUnless(quality.getFragment(0).demoting)
+        self.assertEquals(store.getRAMBytes(), 20)
+        self.failIf(store.reachedMaxBytes())
+
+
+class TestHandoffQueue(unittest.TestCase):
+
+    def testBatch(self):
+        received = []
+        queue = handoff.HandoffQueue(lambda *item: received.append(item))
+
+        def push():
+            for i in range(10):
+                queue.push(('sink', i))
+        t = threading.Thread(target=push)
+        t.start()
+        t.join()
+        self.assertEquals(queue.getDepth(), 10)
+
+        def check(_):
+            self.assertEquals(received, [('sink', i) for i in range(10)])
+            stats = queue.getStats()
+            self.assertEquals(stats['batches'], 1)
+            self.assertEquals(stats['max-depth'], 10)
+            self.assertEquals(stats['mean-batch'], 10.0)
+            self.assertEquals(queue.getStats()['max-depth'], 0)
+        d = task.deferLater(reactor, 0, lambda: None)
+        d.addCallback(check)
+        return d
+
+    def testFailingItem(self):
+        received = []
+
+        def process(sink, i):
+            if i == 1:
+                raise ValueError("malformed fragment")
+            received.append(i)
+        queue = handoff.HandoffQueue(process)
+        for i in range(3):
+            queue.push(('sink', i))
+        d = task.deferLater(reactor, 0, lambda: None)
+        d.addCallback(lambda _: self.assertEquals(received, [0, 2]))
+        return d
+
+
+class TestSharedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'region')
+        self.store = FragmentStore()
+        self.store.DVRWindowLength = 100
+        stream = self.store.getStream('video', 10)
+        self.quality = stream.getQuality(self.store, 1000)
+        self.quality.setStream(stream)
+        self.quality.setTrackId(1)
+        region = shmstore.SharedRegion(path, create=True, dataSize=4096,
+                                       slotSize=4096)
+        self.publisher = shmstore.SharedStorePublisher(region, self.store)
+        self.store.setPublisher(self.publisher)
+        self.reader = shmstore.SharedStoreReader(path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def testLookup(self):
+        self.quality.publishFragment(Fragment(10, 10, ['moof', 'mdat'], 4))
+        self.failIf(self.reader.lookup(
+            'QualityLevels(1000)/Fragments(video=10)'))
+        self.publisher.flush()
+        fragment, kind, mime = self.reader.lookup(
+            'QualityLevels(1000)/Fragments(video=10)')
+        self.assertEquals(fragment.getParts(kind), ['moofmdat'])
+        self.assertEquals(fragment.getETag(kind), '"1-1000-10"')
+        fragment, kind, mime = self.reader.lookup(
+            'QualityLevels(1000)/FragmentInfo(video=10)')
+        self.assertEquals(fragment.getParts(kind), ['moof'])
+        self.assertEquals(self.reader.getFragment('1000', 'video', 10)[2],
+                          200)
+        self.assertEquals(self.reader.getFragment('1000', 'video', 20),
+                          (None, None, 412))
+
+    def testWaitFragment(self):
+        self.quality.publishFragment(Fragment(10, 10, ['data'], 2))
+        self.publisher.flush()
+        d = self.reader.waitFragment('1000', 'video', 20, 60)
+        self.quality.publishFragment(Fragment(20, 10, ['data'], 2))
+        d.addCallback(lambda _: self.assertEquals(
+            self.reader.getFragment('1000', 'video', 20)[2], 200))
+        return d
+
+    def testManifest(self):
+        self.quality.publishFragment(Fragment(10, 10, ['data'], 2))
+        self.publisher.flush()
+        self.assertEquals(self.reader.getManifest(),
+                          self.store.getManifest())
+
+    def testOverwritten(self):
+        self.quality.publishFragment(Fragment(10, 10, ['a' * 1500], 0))
+        self.publisher.flush()
+        path = 'QualityLevels(1000)/Fragments(video=10)'
+        self.failUnless(self.reader.lookup(path))
+        # the ring wraps over the first fragment
+        self.quality.publishFragment(Fragment(20, 10, ['b' * 1500], 0))
+        self.quality.publishFragment(Fragment(30, 10, ['c' * 1500], 0))
+        self.failIf(self.reader.lookup(path))
+
+    def testReattach(self):
+        self.quality.publishFragment(Fragment(10, 10, ['data'], 2))
+        self.publisher.flush()
+        path = 'QualityLevels(1000)/Fragments(video=10)'
+        self.failUnless(self.reader.lookup(path))
+        # the publisher restarts with a new, still empty, region
+        self.publisher.close()
+        region = shmstore.SharedRegion(
+            os.path.join(self.directory, 'region'), create=True,
+            dataSize=4096, slotSize=4096)
+        self.publisher = shmstore.SharedStorePublisher(region, self.store)
+        self.store.setPublisher(self.publisher)
+        self.reader._checked = 0
+        self.failIf(self.reader.lookup(path))
+        self.failIf(self.reader.isReady())
+
+    def testValidOffsets(self):
+        region = self.publisher._region
+        offset = region.writeData(['a' * 100], 100)
+        self.failUnless(region.isValid(offset, 100))
+        # not written yet
+        self.failIf(region.isValid(offset + 100, 10))
+
+    def testParseFragmentPath(self):
+        self.assertEquals(
+            parseFragmentPath('QualityLevels(1000)/FragmentInfo(audio=20)'),
+            ('1000', 'audio', 20, 'info'))
+
+
+EDGE_MANIFEST = """<?xml version="1.0"?>
+<SmoothStreamingMedia MajorVersion="2" MinorVersion="0" TimeScale="10">
+  <StreamIndex Type="video" TimeScale="10">
+    <QualityLevel Bitrate="1000" FourCC="AVC1" CodecPrivateData="00" />
+    <c t="0" />
+    <c t="10" />
+  </StreamIndex>
+</SmoothStreamingMedia>
+"""
+
+
+EDGE_BAD_MANIFEST = """<?xml version="1.0"?>
+<SmoothStreamingMedia MajorVersion="2" MinorVersion="0" TimeScale="10">
+  <StreamIndex Type="video" TimeScale="10" MaxWidth="640" getQuality="x"
+               _timeline="x">
+    <QualityLevel Bitrate="1000" FourCC="AVC1" CodecPrivateData="00"
+                  MaxHeight="480" MaxWidth="wide" _fragments="x"
+                  getFragment="x" />
+    <c t="0" />
+    <c t="10" />
+  </StreamIndex>
+</SmoothStreamingMedia>
+"""
+
+
+class FakeOrigin(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.requests = []
+        self.resources = {
+            'Manifest': EDGE_MANIFEST,
+            'QualityLevels(1000)/Fragments(video=0)': fragment(1, 'a'),
+            'QualityLevels(1000)/Fragments(video=10)': fragment(1, 'b')}
+
+    def render_GET(self, request):
+        path = request.path[len('/mytest/'):]
+        self.requests.append(path)
+        if path not in self.resources:
+            request.setResponseCode(404)
+            return ''
+
+        def reply():
+            request.write(self.resources[path])
+            request.finish()
+        # replies are late, so that requests overlap
+        reactor.callLater(0.01, reply)
+        return server.NOT_DONE_YET
+
+
+class TestEdge(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = FakeOrigin()
+        self.port = reactor.listenTCP(0, server.Site(self.origin),
+                                      interface='127.0.0.1')
+        self.fetcher = edge.HTTPFetcher('http://127.0.0.1:%d/mytest'
+                                        % self.port.getHost().port)
+        self.store = edge.EdgeStore(self.fetcher)
+        self.store.setDVRWindowLength(100)
+
+    def tearDown(self):
+        return defer.DeferredList([defer.maybeDeferred(self.store.close),
+                                   self.port.stopListening()])
+
+    def testCoalescing(self):
+        path = 'QualityLevels(1000)/Fragments(video=0)'
+        d = defer.gatherResults([self.fetcher.fetch(path),
+                                 self.fetcher.fetch(path)])
+        d.addCallback(lambda r: self.assertEquals(r, [fragment(1, 'a')] * 2))
+        d.addCallback(lambda _: self.assertEquals(self.origin.requests,
+                                                  [path]))
+        return d
+
+    def testPrefetch(self):
+
+        def check(_):
+            self.failUnless(self.store.isReady())
+            f, kind, mime = self.store.lookup(
+                'QualityLevels(1000)/Fragments(video=10)')
+            self.assertEquals(f.getParts(), [fragment(1, 'b')])
+            self.assertEquals(f.duration, 10)
+            manifest = self.store.getManifest()[0]
+            self.failUnless('<c t="10" />' in manifest)
+            self.failUnless('CodecPrivateData="00"' in manifest)
+        d = self.store.pollManifest()
+        d.addCallback(check)
+        return d
+
+    def testFetchOnDemand(self):
+        self.origin.resources['QualityLevels(1000)/Fragments(video=20)'] = \
+            fragment(1, 'c')
+
+        def fetch(_):
+            self.assertEquals(self.store.getFragment('1000', 'video', 20),
+                              (None, None, 412))
+            return defer.gatherResults([
+                self.store.waitFragment('1000', 'video', 20, 5),
+                self.store.waitFragment('1000', 'video', 30, 5)])
+
+        def check(_):
+            self.assertEquals(self.store.getFragment('1000', 'video', 20)[2],
+                              200)
+            self.assertEquals(self.origin.requests.count(
+                'QualityLevels(1000)/Fragments(video=20)'), 1)
+            # the upstream doesn't have it
+            self.assertRaises(FragmentNotFound, self.store.getFragment,
+                              '1000', 'video', 30)
+        d = self.store.pollManifest()
+        d.addCallback(fetch)
+        d.addCallback(check)
+        return d
+
+
+    def testManifestAttributes(self):
+        self.origin.resources['Manifest'] = EDGE_BAD_MANIFEST
+
+        def check(_):
+            stream = self.store.getStream('video', 10)
+            q = stream.getQuality(self.store, 1000, False)
+            # only the known attributes are copied, with their types
+            self.assertEquals(stream.MaxWidth, 640)
+            self.assertEquals(q.MaxHeight, 480)
+            self.failIf(hasattr(q, 'MaxWidth'))
+            self.assertEquals(q.getFragmentCount(), 2)
+            self.assertEquals(stream.getQuality(self.store, 1000, False), q)
+            self.failUnless(q.getFragment(10))
+        d = self.store.pollManifest()
+        d.addCallback(check)
+        return d
+
+    def testUnannouncedFragment(self):
+
+        def fetch(_):
+            # not a chunk of the manifest, nor in the lookahead
+            for t in (5, 1000):
+                self.assertRaises(FragmentNotFound, self.store.getFragment,
+                                  '1000', 'video', t)
+            return self.store.waitFragment('1000', 'video', 1000, 5)
+
+        def check(_):
+            self.assertEquals([p for p in self.origin.requests
+                               if 'video=1000' in p or 'video=5)' in p], [])
+        d = self.store.pollManifest()
+        d.addCallback(fetch)
+        d.addCallback(check)
+        return d
+
+
+class TestIngestTimings(unittest.TestCase):
+
+    def testHistogram(self):
+        h = timing.Histogram(samples=100)
+        self.assertEquals(h.getStats()['max'], 0.0)
+        for i in range(200):
+            h.add(i / 1000.0)
+        # only the last 100 samples are kept
+        self.assertEquals(len(h), 100)
+        stats = h.getStats()
+        self.assertAlmostEquals(stats['p50'], 150)
+        self.assertAlmostEquals(stats['p95'], 195)
+        self.assertAlmostEquals(stats['max'], 199)
+
+    def testStats(self):
+        t = timing.IngestTimings()
+        t.add('video-400000', 'parse', 0.001)
+        t.add('video-800000', 'parse', 0.003)
+        t.add('video-800000', 'rewrite', 0.002)
+        stats = t.getStats()
+        self.assertAlmostEquals(stats['video-400000/parse/max'], 1)
+        self.assertAlmostEquals(stats['video-800000/rewrite/p50'], 2)
+        worst = t.getWorst()
+        self.assertAlmostEquals(worst['parse'], 3)
+        self.assertEquals(worst['evict'], 0.0)
+
+    def testLatency(self):
+        t = timing.IngestTimings([timing.AVAILABLE])
+        self.assertEquals(t.getWorst(), {timing.AVAILABLE: 0.0})
+        t.add('audio-64000', timing.AVAILABLE, 4.5)
+        self.assertAlmostEquals(
+            t.getStats(timing.AVAILABLE)['audio-64000/p95'], 4500)
+
+
+class FakeBuffer(bytearray):
+    """
+    A writable gst.Buffer look-alike.
+    """
+
+    def __init__(self, data, timestamp=gst.CLOCK_TIME_NONE, flags=0):
+        bytearray.__init__(self, data)
+        self.timestamp = timestamp
+        self.duration = gst.SECOND
+        self.flags = flags
+        self.caps = None
+
+    data = property(lambda self: str(self))
+
+    def flag_is_set(self, flag):
+        return bool(self.flags & flag)
+
+    def set_caps(self, caps):
+        self.caps = caps
+
+    def make_writable(self):
+        return self
+
+
+class FakeAppSink(object):
+
+    def __init__(self):
+        self.buffers = []
+
+    def connect(self, signal, callback):
+        pass
+
+    def emit(self, signal):
+        return self.buffers.pop(0)
+
+
+class FakeAppSrc(object):
+
+    def __init__(self, lock):
+        self.pushed = []
+        self.pushedLocked = False
+        self._lock = lock
+
+    def emit(self, signal, buf):
+        self.pushedLocked = self.pushedLocked or self._lock.locked()
+        self.pushed.append(buf)
+
+
+class FakeUIState(object):
+
+    def __init__(self):
+        self.dicts = {}
+
+    def addDictKey(self, key, value):
+        self.dicts[key] = value
+
+    def setitem(self, key, name, value):
+        self.dicts[key][name] = value
+
+
+class AggregatorTester(aggregator.FMP4Aggregator):
+
+    def __init__(self, *names):
+        # no pipeline, the sinks are fed by hand
+        self.uiState = FakeUIState()
+        self.init()
+        self._maxQueueDuration = 4 * gst.SECOND
+        self._appsrc = FakeAppSrc(self._lock)
+        self.appsinks = {}
+        for name in names:
+            self.appsinks[name] = FakeAppSink()
+            self._addSink(self.appsinks[name], name)
+            self._sinks[self.appsinks[name]]['got_headers'] = True
+
+    def feed(self, name, seconds):
+        appsink = self.appsinks[name]
+        appsink.buffers.append(FakeBuffer(fragment(1), seconds * gst.SECOND))
+        self._new_buffer(appsink)
+
+    def sendMoov(self, name, bitrate):
+        # the first moov of an input prerolls its sink, the next ones come
+        # when it restarts
+        appsink = self.appsinks[name]
+        buf = FakeBuffer(bench_smoothstreamer.make_moov([bitrate]),
+                         flags=gst.BUFFER_FLAG_IN_CAPS)
+        buf.caps = gst.Caps('video/quicktime, variant=(string)iso')
+        appsink.buffers.append(buf)
+        if self.getSink(name)['got_headers']:
+            self._new_buffer(appsink)
+        else:
+            self._new_preroll(appsink)
+        return buf
+
+    def getSink(self, name):
+        return self._sinks[self.appsinks[name]]
+
+    def getPushed(self):
+        return [(boxes.get_track_id(b), b.timestamp / gst.SECOND)
+                for b in self._appsrc.pushed]
+
+
+class TestAggregator(unittest.TestCase):
+
+    def testOrder(self):
+        agg = AggregatorTester('a', 'b')
+        for name, t in (('a', 0), ('a', 2), ('b', 1), ('b', 3)):
+            agg.feed(name, t)
+        # a's fragments got its track id and wait for b's ones
+        self.assertEquals(agg.getPushed(), [(1, 0), (2, 1), (1, 2)])
+        self.assertEquals(len(agg.getSink('b')['queue']), 1)
+        self.failIf(agg._appsrc.pushedLocked)
+
+    def testDeadInput(self):
+        agg = AggregatorTester('a', 'b')
+        for t in range(4):
+            agg.feed('a', t)
+        self.assertEquals(agg.getPushed(), [])
+        # b is skipped once a got max-queue-duration ahead
+        agg.feed('a', 4)
+        agg.feed('a', 5)
+        self.assertEquals(agg.getPushed(), [(1, 0), (1, 1)])
+        self.assertEquals(agg.getSink('b')['late'], 2)
+
+    def testLateFragment(self):
+        agg = AggregatorTester('a', 'b')
+        for t in range(6):
+            agg.feed('a', t)
+        # older than the last fragment pushed
+        agg.feed('b', 0)
+        self.assertEquals(agg.getSink('b')['dropped'], 1)
+        self.assertEquals(len(agg.getSink('b')['queue']), 0)
+        agg.feed('b', 3)
+        self.assertEquals(agg.getPushed(),
+                          [(1, 0), (1, 1), (1, 2), (1, 3), (2, 3)])
+
+    def testTrimBeforePreroll(self):
+        agg = AggregatorTester('a', 'b')
+        agg.getSink('b')['got_headers'] = False
+        for t in range(7):
+            agg.feed('a', t)
+        self.assertEquals(agg.getPushed(), [])
+        queue = agg.getSink('a')['queue']
+        self.assertEquals([b.timestamp / gst.SECOND for b in queue],
+                          [2, 3, 4, 5, 6])
+        self.assertEquals(agg.getSink('a')['dropped'], 2)
+
+    def _prerolled(self):
+        agg = AggregatorTester('a', 'b')
+        for name, bitrate in (('a', 400000), ('b', 800000)):
+            agg.getSink(name)['got_headers'] = False
+            moov = agg.sendMoov(name, bitrate)
+            # as appsink does
+            agg.appsinks[name].buffers.append(moov)
+            agg._new_buffer(agg.appsinks[name])
+        self.assertEquals(agg._appsrc.pushed, [agg._streamheaders])
+        return agg
+
+    def testRestartSameConfig(self):
+        agg = self._prerolled()
+        moov = agg._moov
+        agg.sendMoov('b', 800000)
+        # nothing to tell downstream, b keeps its track
+        self.assertEquals(len(agg._appsrc.pushed), 1)
+        self.failUnless(agg._moov is moov)
+        self.assertEquals([t.tkhd.id for t in agg._moov.trak], [1, 2])
+        agg.feed('a', 0)
+        agg.feed('b', 0)
+        self.assertEquals(agg.getPushed()[1:], [(1, 0), (2, 0)])
+
+    def testRestartNewConfig(self):
+        agg = self._prerolled()
+        agg.sendMoov('b', 1200000)
+        # b's track is replaced and the new moov pushed downstream
+        self.assertEquals(len(agg._appsrc.pushed), 2)
+        self.failUnless(agg._appsrc.pushed[-1] is agg._streamheaders)
+        self.assertEquals([t.tkhd.id for t in agg._moov.trak], [1, 2])
+        btrt = struct.pack('>III', 0, 1200000, 1200000)
+        self.failUnless(btrt in agg._streamheaders.data)
+        self.failIf(struct.pack('>III', 0, 800000, 800000)
+                    in agg._streamheaders.data)
+        self.assertEquals(agg.getSink('b')['stsd'],
+            boxes.get_sample_description(
+                bench_smoothstreamer.make_moov([1200000])))
+
+    def testPrerollRedelivered(self):
+        agg = AggregatorTester('a')
+        received = []
+        agg._headers_received = lambda appsinkd, buf: received.append(buf)
+        appsink = agg.appsinks['a']
+        agg.getSink('a')['got_headers'] = False
+        moov = bench_smoothstreamer.make_moov([400000])
+        appsink.buffers.append(FakeBuffer(moov, flags=gst.BUFFER_FLAG_IN_CAPS))
+        agg._new_preroll(appsink)
+        agg.getSink('a')['got_headers'] = True
+        # the preroll moov is not taken for a restart
+        appsink.buffers.append(received[0])
+        agg._new_buffer(appsink)
+        self.assertEquals(len(received), 1)
+        appsink.buffers.append(FakeBuffer(moov, flags=gst.BUFFER_FLAG_IN_CAPS))
+        agg._new_buffer(appsink)
+        self.assertEquals(len(received), 2)
+
+    def testStatsWithoutLock(self):
+        agg = AggregatorTester('a', 'b')
+        agg.feed('a', 0)
+        # a streaming thread holding the lock doesn't block the reactor
+        agg._lock.acquire()
+        try:
+            agg._updateStats()
+        finally:
+            agg._lock.release()
+        self.assertEquals(agg.uiState.dicts['queue-depth'], {'a': 1, 'b': 0})
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def testSmallCase(self):
+        r = bench_smoothstreamer.run_case(4, 2, budget=0.01,
+                                          steadyFragments=4)
+        self.assertEquals((r['window'], r['qualities']), (4, 2))
+        for k in ('ingest-fill-rate', 'manifest-render-ms', 'lookup-rate',
+                  'serve-rate'):
+            self.failUnless(r[k] > 0)
+
+
 class TestSmoothStreamer(comptest.CompTestTestCase, log.Loggable):
 
     slow = True # and ugly...
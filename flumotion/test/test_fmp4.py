@@ -26,7 +26,7 @@ from flumotion.common import log, errors
 from flumotion.common.planet import moods
 from flumotion.test import comptest
 
-from flumotion.component.muxers.fmp4 import fmp4
+from flumotion.component.muxers.fmp4 import fmp4, packetizer
 
 import setup
 setup.setup()
@@ -115,3 +115,55 @@ class TestFMP4(comptest.CompTestTestCase):
         # let it run for a few seconds
         d.addCallback(lambda _: comptest.delayed_d(3, _))
         return d
+
+
+class TestPacketizer(unittest.TestCase):
+
+    def setUp(self):
+        self.packetizer = packetizer.Packetizer()
+        self.bus = gst.Bus()
+        self.packetizer.set_bus(self.bus)
+        self.pushed = []
+        self.sinkpad = gst.Pad('sink', gst.PAD_SINK)
+        self.sinkpad.set_chain_function(self._chain)
+        self.packetizer.srcpad.link(self.sinkpad)
+        self.sinkpad.set_active(True)
+        self.packetizer.srcpad.set_active(True)
+        self.packetizer.setcaps(self.packetizer.sinkpad,
+                                gst.Caps('video/quicktime'))
+
+    def _chain(self, pad, buf):
+        self.pushed.append((buf.timestamp / gst.SECOND,
+                            buf.duration / gst.SECOND, len(buf)))
+        return gst.FLOW_OK
+
+    def _chainBuffers(self, count):
+        # one second and 10 bytes each, without GstForceKeyUnit events
+        for i in range(count):
+            buf = gst.Buffer('\0' * 10)
+            buf.timestamp = i * gst.SECOND
+            buf.duration = gst.SECOND
+            self.packetizer.chainfunc(self.packetizer.sinkpad, buf)
+
+    def _countWarnings(self):
+        count = 0
+        while self.bus.pop_filtered(gst.MESSAGE_WARNING):
+            count += 1
+        return count
+
+    def testMaxDuration(self):
+        self.packetizer.set_property('max-duration', 3 * gst.SECOND)
+        self.packetizer.set_property('max-size', 0)
+        self._chainBuffers(7)
+        self.assertEquals(self.pushed, [(0, 3, 30), (3, 3, 30)])
+        self.assertEquals(self._countWarnings(), 1)
+        # the next fragment starts where the last pushed one ends
+        self.assertEquals(self.packetizer._last_event_ts, 6 * gst.SECOND)
+
+    def testMaxSize(self):
+        self.packetizer.set_property('max-duration', 0)
+        self.packetizer.set_property('max-size', 25)
+        self._chainBuffers(7)
+        self.assertEquals(self.pushed, [(0, 3, 30), (3, 3, 30)])
+        self.assertEquals(self._countWarnings(), 1)
+        self.assertEquals(self.packetizer._last_event_ts, 6 * gst.SECOND)